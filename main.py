@@ -3,15 +3,79 @@ import os
 import argparse
 import json
 import logging
+import queue
 import sys
+import threading
 
-# Add the src directory to the system path to allow absolute imports
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), 'src')))
+# Add the src directory to the system path to allow absolute imports.
+# test_runner.py imports main.py, so the directory may be there already.
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'src'))
+if SRC_DIR not in sys.path:
+    sys.path.append(SRC_DIR)
 
 from file_monitor import FileMonitor
 from media_controller import MediaController
 from database import Database
 
+# watchdog is optional: without it (or off Linux) the folder is polled instead
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+class NewFileHandler(FileSystemEventHandler):
+    """
+    Queues the paths of files that were created, closed after writing or
+    moved into the watched folder, and wakes the main loop.
+    """
+    def __init__(self, file_queue, wakeup):
+        super().__init__()
+        self.file_queue = file_queue
+        self.wakeup = wakeup
+
+    def _queue_path(self, path, is_directory):
+        if is_directory:
+            # A folder moved in as a whole does not report its files individually
+            for root, dirs, files in os.walk(path):
+                prefix = root + os.sep
+                for filename in files:
+                    self.file_queue.put(prefix + filename)
+        else:
+            self.file_queue.put(path)
+        self.wakeup.set()
+
+    def on_created(self, event):
+        # inotify reports files and folders moved in from outside the watched
+        # folder as created, not moved
+        self._queue_path(event.src_path, event.is_directory)
+
+    def on_closed(self, event):
+        if not event.is_directory:
+            self._queue_path(event.src_path, False)
+
+    def on_moved(self, event):
+        self._queue_path(event.dest_path, event.is_directory)
+
+def start_observer(input_folder, file_queue, wakeup):
+    """
+    Starts an inotify-backed watchdog observer on the whole input folder.
+    Files moved from elsewhere in it into a processor folder are only
+    reported as moves within the watched tree. Files outside the processor
+    folders are dropped by the FileMonitor.
+    Returns the observer, or None if event-driven monitoring is unavailable.
+    """
+    if Observer is None or not sys.platform.startswith('linux'):
+        return None
+    if not os.path.exists(input_folder):
+        return None
+    observer = Observer()
+    handler = NewFileHandler(file_queue, wakeup)
+    observer.schedule(handler, input_folder, recursive=True)
+    observer.start()
+    return observer
+
 def setup_logging(debug_mode):
     """Sets up basic logging configuration."""
     log_level = logging.DEBUG if debug_mode else logging.INFO
@@ -54,27 +118,69 @@ def main():
         logger.error(f"Unrecoverable error during initialization: {e}")
         return
     
+    # Set by the file watcher and by finished tasks so the main loop only
+    # wakes up when there is likely something to do
+    wakeup = threading.Event()
+
     # Initialize components
     try:
         # Pass the config dictionary directly to the FileMonitor
         file_monitor = FileMonitor(config=config, db=db, debug=args.debug)
-        media_controller = MediaController(config=config, db=db, debug=args.debug)
+        media_controller = MediaController(config=config, db=db, debug=args.debug, wakeup=wakeup)
     except Exception as e:
         logger.error(f"Unrecoverable error during initialization: {e}")
         return
 
+    file_queue = queue.Queue()
+    observer = start_observer(file_monitor.input_parent_folder, file_queue, wakeup)
+    if observer:
+        logger.info("Watching for new files with inotify.")
+    else:
+        logger.info("Event-driven monitoring unavailable. Falling back to polling.")
+
     logger.info("Application started. Monitoring for new files and processing tasks...")
     
     # Main loop
+    monitoring_interval = config.get('monitoring_interval', 5)
+    last_scan = None
+    # Files that arrived while the application was stopped never raise an
+    # event, and some may still be copied. The folder is scanned with the
+    # usual staleness checks until every file found is stable, and only then
+    # do events alone drive ingestion.
+    catching_up = observer is not None
     try:
         while True:
-            file_monitor.check_for_new_files()
+            if observer and not catching_up:
+                while True:
+                    try:
+                        file_monitor.watch_file(file_queue.get_nowait())
+                    except queue.Empty:
+                        break
+                # Reported files get the same staleness checks as scanned ones
+                if file_monitor.has_unstable_files() and (last_scan is None or time.monotonic() - last_scan >= monitoring_interval):
+                    file_monitor.check_watched_files()
+                    last_scan = time.monotonic()
+            elif last_scan is None or time.monotonic() - last_scan >= monitoring_interval:
+                # Staleness checks count scans, so a task finishing early
+                # must not trigger an extra scan
+                file_monitor.check_for_new_files()
+                last_scan = time.monotonic()
+                if catching_up and not file_monitor.has_unstable_files():
+                    catching_up = False
+                    logger.info("Files present at startup are queued. Switching to event-driven ingestion.")
             media_controller.process_pending_tasks()
             file_monitor.purge_completed_inputs()
-            time.sleep(config.get('monitoring_interval', 5))
+            # Sleep until a new file or a finished task, or the interval passes
+            wakeup.wait(timeout=monitoring_interval)
+            wakeup.clear()
     except KeyboardInterrupt:
         logger.info("Application stopped by user.")
     finally:
+        if observer:
+            observer.stop()
+            observer.join()
+        media_controller.shutdown()
+        file_monitor.close()
         db.close()
 
 if __name__ == "__main__":
@@ -1,27 +1,83 @@
+import atexit
 import json
+import queue
 import sqlite3
 import os
-import threading
-from flask import Flask, jsonify, render_template
+from flask import Flask, jsonify, render_template, request
+from flask_caching import Cache
 
-# Lock for thread-safe database access
-DB_LOCK = threading.Lock()
+# Dashboard polls return the same data for a few seconds at a time, so
+# task pages are served from memory instead of re-querying the database
+cache = Cache()
+
+# Only the columns the dashboard renders. output_files is tagged with the
+# JSON converter below so rows come back with it already decoded.
+TASK_COLUMNS = ("id, file_path, processor, processing_params, status, progress, "
+                "COALESCE(output_files, '[]') AS \"output_files [JSON]\"")
+
+def convert_json(value):
+    """
+    Decodes a JSON list column, falling back to an empty list if it is
+    malformed. Older rows were stored double-encoded, as a JSON string
+    holding the list, so a decoded string is decoded once more.
+    """
+    try:
+        decoded = json.loads(value)
+        if isinstance(decoded, str):
+            decoded = json.loads(decoded)
+    except ValueError:
+        return []
+    return decoded if isinstance(decoded, list) else []
+
+sqlite3.register_converter('JSON', convert_json)
+
+# Read-only connections are kept open and reused across requests
+CONNECTION_POOL = queue.LifoQueue(maxsize=8)
 
 def get_db_connection(db_path):
-    """Establishes and returns a new database connection."""
-    conn = sqlite3.connect(db_path, check_same_thread=False)
-    conn.row_factory = sqlite3.Row
-    return conn
-
-def get_tasks(db_path):
-    """Fetches all tasks from the database."""
-    with DB_LOCK:
-        conn = get_db_connection(db_path)
+    """Returns a pooled read-only database connection, opening one if none is free."""
+    try:
+        return CONNECTION_POOL.get_nowait()
+    except queue.Empty:
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False,
+                               detect_types=sqlite3.PARSE_COLNAMES)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+def release_db_connection(conn):
+    """Returns a connection to the pool, closing it if the pool is already full."""
+    try:
+        CONNECTION_POOL.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+@atexit.register
+def close_db_connections():
+    """Closes all pooled connections on shutdown."""
+    while True:
+        try:
+            CONNECTION_POOL.get_nowait().close()
+        except queue.Empty:
+            break
+
+@cache.memoize()
+def get_tasks(db_path, limit, offset):
+    """
+    Fetches one page of tasks from the database, newest first. A negative
+    limit fetches every task from offset on.
+    Returns a list of dictionaries with output_files decoded to a list.
+    """
+    # Each pooled connection is used by one request at a time, and WAL lets
+    # readers run alongside the writer, so no application-level lock is needed
+    conn = get_db_connection(db_path)
+    try:
         cursor = conn.cursor()
-        cursor.execute("SELECT * FROM tasks ORDER BY id DESC")
+        cursor.execute(f"SELECT {TASK_COLUMNS} FROM tasks ORDER BY id DESC LIMIT ? OFFSET ?", (limit, offset))
         tasks = cursor.fetchall()
-        conn.close()
-    return tasks
+    finally:
+        release_db_connection(conn)
+
+    return [dict(task) for task in tasks]
 
 def load_config(config_path):
     """Loads configuration from a JSON file."""
@@ -38,6 +94,11 @@ app.config['CONFIG'] = load_config('config.json')
 if not app.config['CONFIG']:
     raise FileNotFoundError("Dashboard config.json not found.")
 
+cache.init_app(app, config={
+    'CACHE_TYPE': 'SimpleCache',
+    'CACHE_DEFAULT_TIMEOUT': app.config['CONFIG'].get('cache_timeout_seconds', 2),
+})
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -45,28 +106,28 @@ def index():
 @app.route('/api/tasks')
 def api_tasks():
     db_path = app.config['CONFIG']['database_path']
+    page_size = app.config['CONFIG'].get('page_size', 100)
+    try:
+        limit = request.args.get('limit')
+        limit = int(limit) if limit is not None else None
+        offset = int(request.args.get('offset', 0))
+    except ValueError:
+        return jsonify({"error": "limit and offset must be integers"}), 400
+    if (limit is not None and limit < 1) or offset < 0:
+        return jsonify({"error": "limit must be positive and offset must not be negative"}), 400
+    if limit is None:
+        # The dashboard page lists every task, so it asks for no limit.
+        # SQLite reads a negative LIMIT as no limit.
+        limit = -1
+    else:
+        # Larger pages are cut to the configured size
+        limit = min(limit, page_size)
     try:
-        tasks = get_tasks(db_path)
-        print(f"Receivced from get_tasks: {tasks}")
-        task_list = []
-        for task in tasks:
-            print(f"individual task: {tasks}")
-            task_dict = dict(task)
-            # Ensure output_files is a list
-            if isinstance(task_dict.get('output_files'), str):
-                try:
-                    task_dict['output_files'] = json.loads(task_dict['output_files'])
-                except json.JSONDecodeError:
-                    task_dict['output_files'] = []
-            else:
-                task_dict['output_files'] = []
-
-            task_list.append(task_dict)
-        print(f"Final task list to send to frontend: {json.dumps(task_list)}")
-        return jsonify(task_list)
+        tasks = get_tasks(db_path, limit, offset)
     except sqlite3.Error as e:
         print(f"Database error while getting all tasks: {e}")
         return jsonify({"error": "Database error"}), 500
+    return jsonify(tasks)
 
 if __name__ == '__main__':
     app.run(host=app.config['CONFIG']['host'], port=app.config['CONFIG']['port'])
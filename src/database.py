@@ -1,71 +1,146 @@
 import sqlite3
+import sys
 import os
 import json
 import logging
+import threading
+import time
+from contextlib import contextmanager
+
+# Progress-only writes for a task are skipped unless this much time has
+# passed or the progress moved by at least this many percent
+PROGRESS_WRITE_INTERVAL = 1.0
+PROGRESS_WRITE_STEP = 1.0
+
+# Bump when the schema changes and add a matching step to _migrate_schema
+SCHEMA_VERSION = 2
+
+# Hot statements are kept as constants so every call passes the same SQL
+# text and hits the connection's prepared statement cache
+STATEMENT_CACHE_SIZE = 256
+
+# JSON columns are written without the padding spaces json.dumps adds by default
+JSON_SEPARATORS = (',', ':')
+
+# A database_path of ':memory:' keeps the database in memory. All threads of
+# the process share it through this named shared-cache database, which lasts
+# until its last connection is closed.
+IN_MEMORY_PATH = ':memory:'
+IN_MEMORY_URI = 'file:media-processor?mode=memory&cache=shared'
+
+TASK_FIELDS = "id, file_path, processor, processing_params, status, progress"
+
+SQL_ADD_TASK = (
+    "INSERT INTO tasks (file_path, processor, processing_params, status, progress) "
+    "VALUES (?, ?, ?, 'pending', 0.0)"
+)
+SQL_ADD_TASK_IGNORE = (
+    "INSERT OR IGNORE INTO tasks (file_path, processor, processing_params, status, progress) "
+    "VALUES (?, ?, ?, 'pending', 0.0)"
+)
+SQL_GET_FILE_PATHS = "SELECT file_path FROM tasks"
+SQL_GET_TASK = f"SELECT {TASK_FIELDS} FROM tasks WHERE id = ?"
+SQL_GET_TASK_ID = "SELECT id FROM tasks WHERE file_path = ?"
+SQL_DELETE_TASK = "DELETE FROM tasks WHERE id = ?"
+SQL_GET_PENDING = f"SELECT {TASK_FIELDS} FROM tasks WHERE status = 'pending'"
+SQL_GET_COMPLETED = f"SELECT {TASK_FIELDS}, output_files FROM tasks WHERE status = 'completed'"
+SQL_UPDATE_PROGRESS = "UPDATE tasks SET progress = ? WHERE id = ?"
+SQL_UPDATE_PROGRESS_STATUS = "UPDATE tasks SET progress = ?, status = ? WHERE id = ?"
+SQL_SET_COMPLETED = (
+    "UPDATE tasks SET status = ?, progress = 100.0, end_time = CURRENT_TIMESTAMP, "
+    "output_files = COALESCE(?, output_files) WHERE id = ?"
+)
+SQL_SET_FAILED = (
+    "UPDATE tasks SET status = ?, end_time = CURRENT_TIMESTAMP, "
+    "error_message = COALESCE(?, error_message) WHERE id = ?"
+)
+SQL_SET_STATUS = "UPDATE tasks SET status = ? WHERE id = ?"
+SQL_SET_STATUS_OUTPUTS = "UPDATE tasks SET status = ?, output_files = COALESCE(?, output_files) WHERE id = ?"
+SQL_GET_ALL = "SELECT id, file_path, processor, processing_params, output_files, status, progress FROM tasks ORDER BY id DESC"
+SQL_GET_PROBE = "SELECT info FROM probe_cache WHERE file_path = ? AND mtime_ns = ? AND size = ?"
+SQL_SAVE_PROBE = "INSERT OR REPLACE INTO probe_cache (file_path, mtime_ns, size, info) VALUES (?, ?, ?, ?)"
 
 class Database:
     def __init__(self, config, debug=False):
         self.debug = debug
-        self.config_path = ""
         self.config = config
         self.db_path = self._get_db_path()
-        self.conn = None
-        self.cursor = None
+        # Each thread gets its own connection so worker threads can write safely
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        # task_id -> (monotonic time, progress) of the last progress write
+        self._last_progress = {}
         if self.debug:
             logging.basicConfig(level=logging.DEBUG)
         else:
             logging.basicConfig(level=logging.INFO)
             
-    def _load_config(self):
-        try:
-            with open(self.config_path, 'r') as f:
-                return json.load(f)
-        except FileNotFoundError:
-            logging.error(f"Configuration file not found at {self.config_path}")
-            return {}
-        except json.JSONDecodeError:
-            logging.error(f"Invalid JSON in configuration file at {self.config_path}")
-            return {}
-
     def _get_db_path(self):
         """Builds the absolute path to the database file."""
-        #config_dir = os.path.dirname(self.config_path)
-        #relative_db_path = self.config.get('database_path', 'data/progress.db')
-        #abs_path = os.path.normpath(os.path.join(config_dir, relative_db_path))
         abs_path = self.config.get('database_path', 'data/progress.db')
         if self.debug:
             logging.debug(f"Database path: {abs_path}")
         return abs_path
 
+    @property
+    def conn(self):
+        """The calling thread's connection, opened on first use."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+        return conn
+
+    @property
+    def cursor(self):
+        """The calling thread's cursor."""
+        cursor = getattr(self._local, 'cursor', None)
+        if cursor is None:
+            cursor = self.conn.cursor()
+            self._local.cursor = cursor
+        return cursor
+
+    def _connect(self):
+        """Opens a tuned connection for the calling thread."""
+        if self.db_path == IN_MEMORY_PATH:
+            conn = sqlite3.connect(IN_MEMORY_URI, uri=True, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+            # Nothing is written to disk, so there is nothing to journal or sync
+            conn.executescript('''
+                PRAGMA journal_mode=MEMORY;
+                PRAGMA synchronous=OFF;
+                PRAGMA temp_store=MEMORY;
+            ''')
+        else:
+            conn = sqlite3.connect(self.db_path, check_same_thread=False, cached_statements=STATEMENT_CACHE_SIZE)
+            # WAL lets the dashboard read while we write, and NORMAL sync
+            # drops the fsync from every commit
+            conn.executescript('''
+                PRAGMA journal_mode=WAL;
+                PRAGMA synchronous=NORMAL;
+                PRAGMA temp_store=MEMORY;
+                PRAGMA cache_size=-20000;
+                PRAGMA mmap_size=268435456;
+            ''')
+        self._local.conn = conn
+        self._local.cursor = conn.cursor()
+        with self._connections_lock:
+            self._connections.append(conn)
+        if self.debug:
+            logging.debug(f"Opened database connection for thread '{threading.current_thread().name}'.")
+        return conn
+
     def initialize_database(self):
         """Initializes the database connection and creates the tasks table."""
         try:
             # Create the directory if it doesn't exist
             db_dir = os.path.dirname(self.db_path)
-            if not os.path.exists(db_dir):
+            if db_dir and not os.path.exists(db_dir):
                 os.makedirs(db_dir)
                 if self.debug:
                     logging.debug(f"Created database directory at {db_dir}")
 
-            self.conn = sqlite3.connect(self.db_path)
-            self.cursor = self.conn.cursor()
-            
-            # Create the tasks table with a new output_files column
-            self.cursor.execute('''
-                CREATE TABLE IF NOT EXISTS tasks (
-                    id INTEGER PRIMARY KEY,
-                    file_path TEXT NOT NULL UNIQUE,
-                    processor TEXT NOT NULL,
-                    processing_params TEXT,
-                    output_files TEXT,
-                    status TEXT NOT NULL,
-                    progress REAL,
-                    start_time TEXT,
-                    end_time TEXT,
-                    error_message TEXT
-                )
-            ''')
-            self.conn.commit()
+            self._connect()
+            self._migrate_schema()
             if self.debug:
                 logging.debug("Database initialized and 'tasks' table is ready.")
             return True
@@ -73,51 +148,184 @@ class Database:
             logging.error(f"Database error during initialization: {e}")
             return False
 
+    def _migrate_schema(self):
+        """
+        Brings the schema up to SCHEMA_VERSION, tracked in PRAGMA user_version.
+        Each version step runs once per database file.
+        """
+        version = self.cursor.execute('PRAGMA user_version').fetchone()[0]
+        if version >= SCHEMA_VERSION:
+            return
+
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            if version < 1:
+                # Create the tasks table. IF NOT EXISTS adopts databases
+                # created before versioning was introduced.
+                self.cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS tasks (
+                        id INTEGER PRIMARY KEY,
+                        file_path TEXT NOT NULL UNIQUE,
+                        processor TEXT NOT NULL,
+                        processing_params TEXT,
+                        output_files TEXT,
+                        status TEXT NOT NULL,
+                        progress REAL,
+                        start_time TEXT,
+                        end_time TEXT,
+                        error_message TEXT
+                    )
+                ''')
+                # Pending/completed lookups run every cycle. file_path is already
+                # indexed through its UNIQUE constraint.
+                self.cursor.execute('CREATE INDEX IF NOT EXISTS idx_tasks_status ON tasks(status, id)')
+            if version < 2:
+                # ffprobe results, reused while the file's mtime and size match
+                self.cursor.execute('''
+                    CREATE TABLE IF NOT EXISTS probe_cache (
+                        file_path TEXT PRIMARY KEY,
+                        mtime_ns INTEGER NOT NULL,
+                        size INTEGER NOT NULL,
+                        info TEXT NOT NULL
+                    )
+                ''')
+            self.cursor.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+            self.conn.commit()
+        except sqlite3.Error:
+            self.conn.rollback()
+            raise
+        if self.debug:
+            logging.debug(f"Database schema migrated from version {version} to {SCHEMA_VERSION}.")
+
     def close(self):
-        """Closes the database connection."""
-        if self.conn:
-            self.conn.close()
+        """Closes the database connections of all threads."""
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+        self._local = threading.local()
 
-    def add_task(self, file_path, processor, processing_params):
-        """Adds a new task to the database."""
+    @contextmanager
+    def transaction(self):
+        """
+        Groups several writes on the calling thread into one transaction.
+        Commits when the block exits and rolls back if it raises. Write
+        methods called inside the block do not commit on their own, and
+        raise their database errors instead of logging them, so a failed
+        write rolls back the whole block.
+        Nested blocks join the outermost transaction.
+        """
+        depth = getattr(self._local, 'transaction_depth', 0)
+        if depth == 0:
+            self.conn.execute('BEGIN IMMEDIATE')
+        self._local.transaction_depth = depth + 1
+        try:
+            yield self
+        except BaseException:
+            self._local.transaction_depth = depth
+            if depth == 0:
+                self.conn.rollback()
+            raise
+        self._local.transaction_depth = depth
+        if depth == 0:
+            self.conn.commit()
+
+    def _in_transaction(self):
+        """Tells whether the calling thread is inside a transaction block."""
+        return getattr(self._local, 'transaction_depth', 0) > 0
+
+    def _commit(self):
+        """Commits the calling thread's writes unless a transaction block is open."""
+        if not self._in_transaction():
+            self.conn.commit()
+
+    def add_task(self, file_path, processor, params_json):
+        """
+        Adds a new task to the database.
+        params_json is the processing parameters already encoded as JSON.
+        """
         try:
             if self.debug:
                 logging.debug(f"Adding task for '{file_path}' with processor '{processor}'.")
             
-            status = 'pending'
-            
-            self.cursor.execute('''
-                INSERT INTO tasks (file_path, processor, processing_params, status, progress)
-                VALUES (?, ?, ?, ?, ?)
-            ''', (file_path, processor, json.dumps(processing_params), status, 0.0))
-            self.conn.commit()
+            self.cursor.execute(SQL_ADD_TASK, (file_path, processor, params_json))
+            self._commit()
             return self.cursor.lastrowid
         except sqlite3.IntegrityError:
             if self.debug:
                 logging.debug(f"Task for '{file_path}' already exists.")
             return None
         except sqlite3.Error as e:
+            if self._in_transaction():
+                raise
             logging.error(f"Database error while adding task: {e}")
             return None
 
-    def is_task_recorded(self, file_path):
+    def add_tasks_bulk(self, tasks):
         """
-        Checks if a task with the given file path already exists in the database.
-        Returns True if a task exists, False otherwise.
+        Adds several new tasks in a single transaction.
+        Each task is a (file_path, processor, params_json) tuple, with the
+        parameters already encoded as JSON. Files that already have a task
+        are ignored.
+        Returns the number of tasks added, or None if the insert failed.
         """
+        if not tasks:
+            return 0
         try:
-            self.cursor.execute('''
-                SELECT EXISTS(SELECT 1 FROM tasks WHERE file_path = ?)
-            ''', (file_path,))
-            return self.cursor.fetchone()[0] == 1
+            if self.debug:
+                logging.debug(f"Adding {len(tasks)} tasks in a single transaction.")
+
+            with self.transaction():
+                self.cursor.executemany(SQL_ADD_TASK_IGNORE, tasks)
+            return self.cursor.rowcount
         except sqlite3.Error as e:
-            logging.error(f"Database error while checking for task: {e}")
-            return False
+            logging.error(f"Database error while adding tasks in bulk: {e}")
+            return None
+
+    def get_all_file_paths(self):
+        """
+        Retrieves the input paths of all recorded tasks.
+        Returns a set of interned file paths.
+        """
+        try:
+            return {sys.intern(row[0]) for row in self.cursor.execute(SQL_GET_FILE_PATHS)}
+        except sqlite3.Error as e:
+            logging.error(f"Database error while getting recorded file paths: {e}")
+            return set()
+
+    def get_task(self, task_id):
+        """Retrieves a single task by its ID, or None if it does not exist."""
+        try:
+            self.cursor.execute(SQL_GET_TASK, (task_id,))
+            return self.cursor.fetchone()
+        except sqlite3.Error as e:
+            logging.error(f"Database error while getting task {task_id}: {e}")
+            return None
+
+    def get_task_id(self, file_path):
+        """Retrieves the ID of the task for file_path, or None if it has none."""
+        try:
+            row = self.cursor.execute(SQL_GET_TASK_ID, (file_path,)).fetchone()
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            logging.error(f"Database error while getting the task for '{file_path}': {e}")
+            return None
+
+    def delete_task(self, task_id):
+        """Removes a task from the database."""
+        self._last_progress.pop(task_id, None)
+        try:
+            self.cursor.execute(SQL_DELETE_TASK, (task_id,))
+            self._commit()
+        except sqlite3.Error as e:
+            if self._in_transaction():
+                raise
+            logging.error(f"Database error while deleting task {task_id}: {e}")
 
     def get_pending_tasks(self):
         """Retrieves all pending tasks from the database."""
         try:
-            self.cursor.execute("SELECT id, file_path, processor, processing_params, status, progress FROM tasks WHERE status = 'pending'")
+            self.cursor.execute(SQL_GET_PENDING)
             return self.cursor.fetchall()
         except sqlite3.Error as e:
             logging.error(f"Database error while getting pending tasks: {e}")
@@ -128,51 +336,107 @@ class Database:
         Retrieves all completed tasks that have not yet been purged.
         """
         try:
-            self.cursor.execute("SELECT id, file_path, processor, processing_params, status, progress, output_files FROM tasks WHERE status = 'completed'")
+            self.cursor.execute(SQL_GET_COMPLETED)
             return self.cursor.fetchall()
         except sqlite3.Error as e:
             logging.error(f"Database error while getting completed tasks: {e}")
             return []
 
     def update_task_progress(self, task_id, progress, status=None):
-        """Updates the progress and optional status of a task."""
+        """
+        Updates the progress and optional status of a task.
+        FFmpeg reports progress many times a second, so progress-only updates
+        are dropped if the last write was under PROGRESS_WRITE_INTERVAL ago and
+        moved less than PROGRESS_WRITE_STEP. Updates with a status always write.
+        """
+        now = time.monotonic()
+        if status is None:
+            last = self._last_progress.get(task_id)
+            if last and now - last[0] < PROGRESS_WRITE_INTERVAL and abs(progress - last[1]) < PROGRESS_WRITE_STEP:
+                return
         try:
             if status:
-                self.cursor.execute("UPDATE tasks SET progress = ?, status = ? WHERE id = ?", (progress, status, task_id))
+                self.cursor.execute(SQL_UPDATE_PROGRESS_STATUS, (progress, status, task_id))
             else:
-                self.cursor.execute("UPDATE tasks SET progress = ? WHERE id = ?", (progress, task_id))
-            self.conn.commit()
+                self.cursor.execute(SQL_UPDATE_PROGRESS, (progress, task_id))
+            self._commit()
+            self._last_progress[task_id] = (now, progress)
         except sqlite3.Error as e:
+            if self._in_transaction():
+                raise
             logging.error(f"Database error while updating task progress: {e}")
 
-    def update_task_status(self, task_id, status, error_message=None):
-        """Updates the status of a task."""
+    def update_task_status(self, task_id, status, error_message=None, output_files=None):
+        """
+        Updates the status of a task.
+        If output_files is given, the task's output file list is stored in the
+        same statement.
+        """
+        if status in ('completed', 'failed'):
+            self._last_progress.pop(task_id, None)
+        outputs_json = json.dumps(output_files, separators=JSON_SEPARATORS) if output_files is not None else None
         try:
             if status == 'completed':
-                self.cursor.execute("UPDATE tasks SET status = ?, progress = 100.0, end_time = CURRENT_TIMESTAMP WHERE id = ?", (status, task_id))
+                self.cursor.execute(SQL_SET_COMPLETED, (status, outputs_json, task_id))
             elif status == 'failed':
-                self.cursor.execute("UPDATE tasks SET status = ?, end_time = CURRENT_TIMESTAMP, error_message = ? WHERE id = ?", (status, error_message, task_id))
+                self.cursor.execute(SQL_SET_FAILED, (status, error_message, task_id))
             elif status == 'purged':
-                self.cursor.execute("UPDATE tasks SET status = ? WHERE id = ?", (status, task_id))
+                self.cursor.execute(SQL_SET_STATUS, (status, task_id))
             else:
-                self.cursor.execute("UPDATE tasks SET status = ? WHERE id = ?", (status, task_id))
-            self.conn.commit()
+                self.cursor.execute(SQL_SET_STATUS_OUTPUTS, (status, outputs_json, task_id))
+            self._commit()
         except sqlite3.Error as e:
+            if self._in_transaction():
+                raise
             logging.error(f"Database error while updating task status: {e}")
     
-    def update_task_output_files(self, task_id, output_files):
-        """Updates the output files of a completed task."""
+    def get_probe_info(self, file_path, mtime_ns, size):
+        """
+        Retrieves the cached probe results of a media file as a dictionary.
+        Returns None if the file was not probed at this mtime and size.
+        """
         try:
-            self.cursor.execute("UPDATE tasks SET output_files = ? WHERE id = ?", (json.dumps(output_files), task_id))
-            self.conn.commit()
+            row = self.cursor.execute(SQL_GET_PROBE, (file_path, mtime_ns, size)).fetchone()
+            return json.loads(row[0]) if row else None
         except sqlite3.Error as e:
-            logging.error(f"Database error while updating output files: {e}")
+            logging.error(f"Database error while getting probe info: {e}")
+            return None
+
+    def save_probe_info(self, file_path, mtime_ns, size, info):
+        """Caches the probe results of a media file, replacing older results."""
+        try:
+            self.cursor.execute(SQL_SAVE_PROBE, (file_path, mtime_ns, size, json.dumps(info, separators=JSON_SEPARATORS)))
+            self._commit()
+        except sqlite3.Error as e:
+            if self._in_transaction():
+                raise
+            logging.error(f"Database error while saving probe info: {e}")
+
     def get_all_tasks(self):
         """Retrieves all tasks from the database."""
         try:
-            self.cursor.execute("SELECT id, file_path, processor, processing_params, output_files, status, progress FROM tasks ORDER BY id DESC")
+            self.cursor.execute(SQL_GET_ALL)
             return self.cursor.fetchall()
         except sqlite3.Error as e:
             logging.error(f"Database error while getting all tasks: {e}")
             return []
 
+    def iter_all_tasks(self, batch_size=1000):
+        """
+        Yields all tasks like get_all_tasks, fetching batch_size rows at a
+        time so the whole table is never held in memory. Uses a cursor of its
+        own, so other queries can run while the rows are consumed.
+        """
+        cursor = self.conn.cursor()
+        try:
+            cursor.execute(SQL_GET_ALL)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    return
+                yield from rows
+        except sqlite3.Error as e:
+            logging.error(f"Database error while iterating over all tasks: {e}")
+        finally:
+            cursor.close()
+
@@ -1,8 +1,23 @@
 import os
+import re
 import json
 import logging
 import time
 import sqlite3
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from database import JSON_SEPARATORS
+
+MEDIA_EXTENSIONS = frozenset({'.mp4', '.mkv', '.mov', '.mp3', '.flac'})
+
+# Where supported (POSIX), folders are listed through an open descriptor so
+# DirEntry.stat() resolves each file relative to it instead of the full path
+SCAN_BY_FD = os.scandir in os.supports_fd and os.stat in os.supports_dir_fd
+
+# Folder listings are only reused once the folder's mtime is at least this
+# old, so a change in the same timestamp tick as a scan is never missed
+FOLDER_CACHE_MIN_AGE_NS = 2_000_000_000
 
 class FileMonitor:
     def __init__(self, config, db, debug=False):
@@ -17,30 +32,168 @@ class FileMonitor:
 
         self.input_parent_folder = self.config.get('input_parent_folder')
         self.processors = self.config.get('processors')
+        # Length of the parent folder plus its separator, sliced off file
+        # folders to get the path relative to the parent
+        self._parent_prefix_len = len(self.input_parent_folder.rstrip(os.sep)) + 1
         # NEW: Dictionary to store file status for staleness checks
         self.file_status = {}
+        # Incremented every scan. Each file_status entry records the scan it
+        # was last seen in, so entries for vanished files can be swept.
+        self._scan_generation = 0
+        # Stable files no processor handles. The processors are fixed, so
+        # later scans skip them instead of checking their staleness again.
+        self._unmatched_paths = set()
+        # Folder path -> (mtime_ns, sub-folder paths, media file paths) from
+        # the last scan that listed it
+        self._folder_cache = {}
         # NEW: Get staleness check count from config
         self.staleness_check_count = self.config.get('staleness_check_count', 3)
+        # Stats on network shares are slow but release the GIL, so they can
+        # optionally run on a pool of threads. 0 stats files during the scan.
+        stat_workers = int(self.config.get('stat_workers', 0))
+        self._stat_pool = ThreadPoolExecutor(max_workers=stat_workers, thread_name_prefix='StatWorker') if stat_workers > 0 else None
+        # Extensions picked up by the scan, from each processor's input_file_extensions
+        extensions = set()
+        for proc in self.processors:
+            extensions.update(ext.lower() for ext in proc.get('input_file_extensions', MEDIA_EXTENSIONS))
+        self.media_extensions = frozenset(extensions) or MEDIA_EXTENSIONS
+        # All processor input paths compiled into one regex, one capturing
+        # group per processor. Paths are normalized once here, so 'video/' or
+        # './video' in the config still match. Longer paths come first so
+        # nested processor folders win over their parents.
+        self._dispatch_procs = sorted(
+            ((os.path.normpath(proc['input_path']), proc) for proc in self.processors),
+            key=lambda item: len(item[0]),
+            reverse=True,
+        )
+        sep = re.escape(os.sep)
+        self._dispatch_re = re.compile('^(?:' + '|'.join(
+            f"({re.escape(input_path)}(?:{sep}.*)?)" for input_path, _ in self._dispatch_procs
+        ) + ')$', re.DOTALL)
         self.logger.debug(f"FileMonitor initialized. Monitoring '{self.input_parent_folder}'.")
 
     def _get_processor_config(self, input_path):
         """
         Determines the correct processor configuration based on the file's sub-folder.
-        Returns the processor dictionary from config and the sub-path suffix.
+        Returns the processor dictionary from config and the list of sub-folder
+        names below its input path.
         """
-        sub_path = os.path.dirname(input_path).replace(self.input_parent_folder, '').strip(os.path.sep)
-        
-        for proc in self.processors:
-            if sub_path.startswith(proc['input_path']):
-                return proc, sub_path.replace(proc['input_path'], '').strip(os.path.sep)
-        return None, None
+        sub_path = os.path.dirname(input_path)[self._parent_prefix_len:]
+
+        # A processor path must be followed by a separator or the end, so
+        # 'video' does not match 'video2'
+        match = self._dispatch_re.match(sub_path)
+        if match is None:
+            return None, None
+        input_path, proc = self._dispatch_procs[match.lastindex - 1]
+        rest = sub_path[len(input_path) + 1:]
+        return proc, rest.split(os.sep) if rest else []
         
-    def _get_processor_params(self, input_path_suffix):
+    def _get_processor_params(self, input_path_segments):
         """
-        Extracts processing parameters from the input path suffix.
+        Extracts processing parameters from the sub-folders below the input path.
         Returns a list of strings from the sub-folder names.
         """
-        return input_path_suffix.split(os.path.sep)
+        return list(input_path_segments)
+
+    def _get_folder_task(self, file_path):
+        """
+        Returns the processor name and JSON-encoded parameters for files in
+        the folder of file_path, or (None, None) if no processor matches.
+        """
+        processor_config, input_path_segments = self._get_processor_config(file_path)
+        if not processor_config:
+            return None, None
+        params = self._get_processor_params(input_path_segments)
+        return processor_config['name'], json.dumps(params, separators=JSON_SEPARATORS)
+
+    def _is_media_file(self, name):
+        """
+        Checks a file name against the media extensions. Only the text after
+        the last dot is lowercased and looked up, not the whole path.
+        """
+        dot = name.rfind('.')
+        return dot != -1 and name[dot:].lower() in self.media_extensions
+
+    def _iter_media_files(self, root):
+        """
+        Yields (path, DirEntry) for every media file under root.
+        os.scandir reports file types from the directory listing itself, so
+        entries are filtered without a stat call each. Folders are walked from
+        an explicit queue rather than by recursion. Symlinks are not followed.
+        The entry's stat() is only valid until the next item is requested.
+
+        Creating, deleting or renaming files updates a folder's mtime, so a
+        folder whose mtime has not changed since the last scan is not listed
+        again. Its files come from the cached listing and are yielded with
+        None as the entry.
+        """
+        folders = deque([root])
+        visited = set()
+        while folders:
+            folder = folders.popleft()
+            visited.add(folder)
+            try:
+                mtime_ns = os.stat(folder).st_mtime_ns
+                cached = self._folder_cache.get(folder)
+                if cached is not None and cached[0] == mtime_ns:
+                    folders.extend(cached[1])
+                    for file_path in cached[2]:
+                        yield file_path, None
+                    continue
+
+                subfolders = []
+                media_files = []
+                if SCAN_BY_FD:
+                    fd = os.open(folder, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0))
+                    try:
+                        yield from self._scan_folder(folder, fd, subfolders, media_files)
+                    finally:
+                        os.close(fd)
+                else:
+                    yield from self._scan_folder(folder, folder, subfolders, media_files)
+                folders.extend(subfolders)
+                if time.time_ns() - mtime_ns >= FOLDER_CACHE_MIN_AGE_NS:
+                    self._folder_cache[folder] = (mtime_ns, subfolders, media_files)
+                else:
+                    self._folder_cache.pop(folder, None)
+            except OSError as e:
+                self.logger.warning(f"Could not scan folder '{folder}': {e}")
+
+        # Forget folders that no longer exist
+        for folder in self._folder_cache.keys() - visited:
+            del self._folder_cache[folder]
+
+    def _scan_folder(self, folder, target, subfolders, media_files):
+        """
+        Lists one folder, given by path or open descriptor as target. Yields
+        (path, DirEntry) for its media files and collects the paths of its
+        sub-folders and media files.
+        """
+        # Entries listed through a descriptor only carry their name
+        prefix = folder.rstrip(os.sep) + os.sep
+        with os.scandir(target) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    subfolders.append(prefix + entry.name)
+                elif entry.is_file(follow_symlinks=False) and self._is_media_file(entry.name):
+                    file_path = prefix + entry.name
+                    media_files.append(file_path)
+                    yield file_path, entry
+
+    def _get_file_state(self, file):
+        """
+        Returns (size, mtime_ns) for a DirEntry or a path, or None if the
+        file can no longer be read.
+        """
+        try:
+            if isinstance(file, os.DirEntry):
+                stat = file.stat(follow_symlinks=False)
+            else:
+                stat = os.stat(file, follow_symlinks=False)
+        except OSError:
+            return None
+        return (stat.st_size, stat.st_mtime_ns)
 
     def check_for_new_files(self):
         """
@@ -54,69 +207,166 @@ class FileMonitor:
             self.logger.error(f"Input parent folder not found: {self.input_parent_folder}. Skipping scan.")
             return
 
-        # NEW: Create a set of files found in the current scan
-        current_files = set()
+        self._scan_generation += 1
+        generation = self._scan_generation
+        # One query per scan instead of one per file
+        recorded_paths = self.db.get_all_file_paths()
 
-        for root, dirs, files in os.walk(self.input_parent_folder):
-            self.logger.debug(f"Scanning folder: {root}")
-            for filename in files:
-                file_path = os.path.join(root, filename)
-                current_files.add(file_path)
+        # Unmatched files seen this scan, so ones that vanished are forgotten
+        unmatched_seen = set()
 
-                # Skip if file has already been recorded in the database
-                if self.db.is_task_recorded(file_path):
-                    self.logger.debug(f"Skipping '{file_path}': already recorded.")
-                    continue
-                
-                # Check if file is a media file based on extension
-                if not any(file_path.lower().endswith(ext) for ext in ['.mp4', '.mkv', '.mov', '.mp3', '.flac']):
-                    continue
-                
-                # NEW: Get current file size
-                try:
-                    current_size = os.path.getsize(file_path)
-                except FileNotFoundError:
-                    self.logger.debug(f"File '{file_path}' disappeared before size could be checked. Skipping.")
-                    continue
-                
-                # Check file staleness
-                if file_path in self.file_status:
-                    # File is already being monitored
-                    previous_size, counter = self.file_status[file_path]
-                    if current_size == previous_size:
-                        # Size is stable, increment counter
-                        self.file_status[file_path] = (current_size, counter + 1)
-                        self.logger.debug(f"File '{file_path}' is stable. Count: {counter + 1}/{self.staleness_check_count}")
-                    else:
-                        # Size changed, reset counter
-                        self.file_status[file_path] = (current_size, 1)
-                        self.logger.debug(f"File '{file_path}' size changed. Resetting count.")
+        # (file path, (size, mtime_ns)) of every unrecorded media file
+        candidates = []
+        for file_path, entry in self._iter_media_files(self.input_parent_folder):
+            # Recorded paths are interned too, so set and dict lookups
+            # below match on identity instead of comparing the strings
+            file_path = sys.intern(file_path)
+
+            # Skip if file has already been recorded in the database
+            if file_path in recorded_paths:
+                self.logger.debug(f"Skipping '{file_path}': already recorded.")
+                continue
+
+            if file_path in self._unmatched_paths:
+                unmatched_seen.add(file_path)
+                continue
+
+            if self._stat_pool is None:
+                # The scandir entry is only valid during the walk. On Linux
+                # this is the only stat the file gets per scan.
+                candidates.append((file_path, self._get_file_state(entry if entry is not None else file_path)))
+            else:
+                candidates.append(file_path)
+
+        if self._stat_pool is not None:
+            candidates = list(zip(candidates, self._stat_pool.map(self._get_file_state, candidates)))
+
+        new_tasks = self._check_staleness(candidates, generation, unmatched_seen)
+        self._add_stable_tasks(new_tasks)
+        self._forget_unseen(generation)
+        self._unmatched_paths = unmatched_seen
+
+    def _check_staleness(self, candidates, generation, unmatched_seen):
+        """
+        Updates the staleness counts of the (file path, (size, mtime_ns))
+        candidates. Stable files no processor handles are no longer monitored
+        and are added to unmatched_seen.
+        Returns the (file_path, processor, params_json) tasks of the others.
+        """
+        new_tasks = []
+        # Folder -> (processor name, JSON-encoded params). Every file in a
+        # folder maps to the same processor and params, so they are worked
+        # out and encoded once per folder.
+        folder_tasks = {}
+        for file_path, current_state in candidates:
+            if current_state is None:
+                self.logger.debug(f"File '{file_path}' disappeared before size could be checked. Skipping.")
+                continue
+            
+            # Check file staleness
+            if file_path in self.file_status:
+                # File is already being monitored
+                previous_state, counter, _ = self.file_status[file_path]
+                if current_state == previous_state:
+                    # Size and mtime are stable, increment counter
+                    self.file_status[file_path] = (current_state, counter + 1, generation)
+                    self.logger.debug(f"File '{file_path}' is stable. Count: {counter + 1}/{self.staleness_check_count}")
+                else:
+                    # File was written to, reset counter
+                    self.file_status[file_path] = (current_state, 1, generation)
+                    self.logger.debug(f"File '{file_path}' changed. Resetting count.")
+            else:
+                # New file, start monitoring
+                self.file_status[file_path] = (current_state, 1, generation)
+                self.logger.debug(f"New file '{file_path}' detected. Starting staleness check.")
+
+            # Check if the file is now considered stable
+            if self.file_status[file_path][1] >= self.staleness_check_count:
+                folder = os.path.dirname(file_path)
+                if folder not in folder_tasks:
+                    folder_tasks[folder] = self._get_folder_task(file_path)
+                processor_name, params_json = folder_tasks[folder]
+                if processor_name:
+                    self.logger.debug(f"Queuing task for '{file_path}' with processor '{processor_name}'.")
+                    # Monitoring stops once the task is in the database
+                    new_tasks.append((file_path, processor_name, params_json))
                 else:
-                    # New file, start monitoring
-                    self.file_status[file_path] = (current_size, 1)
-                    self.logger.debug(f"New file '{file_path}' detected. Starting staleness check.")
-
-                # Check if the file is now considered stable
-                if self.file_status.get(file_path, (0, 0))[1] >= self.staleness_check_count:
-                    processor_config, input_path_suffix = self._get_processor_config(file_path)
-                    if processor_config:
-                        processor_name = processor_config['name']
-                        params = self._get_processor_params(input_path_suffix)
-                        self.logger.debug(f"Adding task for '{file_path}' with processor '{processor_name}'.")
-                        if self.db.add_task(file_path, processor_name, params):
-                            self.logger.info(f"Task added for '{file_path}' with processor '{processor_name}'.")
-                            # Remove file from monitoring once added to DB
-                            del self.file_status[file_path]
-                    else:
-                        self.logger.warning(f"No processor found for path: {file_path}. Skipping and removing from check.")
-                        # Stop monitoring this file
-                        del self.file_status[file_path]
-
-        # NEW: Remove files from monitoring that are no longer present
-        files_to_remove = [p for p in self.file_status if p not in current_files]
-        for p in files_to_remove:
-            self.logger.debug(f"File '{p}' removed from monitoring as it no longer exists.")
-            del self.file_status[p]
+                    self.logger.warning(f"No processor found for path: {file_path}. Skipping and removing from check.")
+                    # Stop monitoring this file, and skip it in later scans
+                    del self.file_status[file_path]
+                    unmatched_seen.add(file_path)
+        return new_tasks
+
+    def _add_stable_tasks(self, new_tasks):
+        """
+        Commits the tasks of the files that became stable in one transaction
+        and stops monitoring those files. If the insert fails they stay
+        monitored, so the next check queues them again.
+        """
+        if not new_tasks:
+            return
+        added = self.db.add_tasks_bulk(new_tasks)
+        if added is None:
+            self.logger.warning(f"Could not add the tasks of {len(new_tasks)} stable file(s). Retrying on the next check.")
+            return
+        for file_path, _, _ in new_tasks:
+            del self.file_status[file_path]
+        self.logger.info(f"Added {added} new task(s) from {len(new_tasks)} stable file(s).")
+
+    def _forget_unseen(self, generation):
+        """Stops monitoring files that were not seen by the check of this generation."""
+        for p, (_, _, seen) in list(self.file_status.items()):
+            if seen != generation:
+                self.logger.debug(f"File '{p}' removed from monitoring as it no longer exists.")
+                del self.file_status[p]
+
+    def has_unstable_files(self):
+        """Tells whether files found by earlier scans or events are still waiting to become stable."""
+        return bool(self.file_status)
+
+    def watch_file(self, file_path):
+        """
+        Starts the staleness check for a file reported by the file system
+        watcher, without scanning the whole input folder. Not every writer
+        closes a file once, when it is done, so the file is only queued once
+        check_watched_files has seen it unchanged staleness_check_count times.
+        """
+        if not self._is_media_file(os.path.basename(file_path)):
+            self.logger.debug(f"Skipping '{file_path}': not a media file.")
+            return
+        file_path = sys.intern(file_path)
+        if file_path in self.file_status:
+            return
+
+        processor_name, _ = self._get_folder_task(file_path)
+        if not processor_name:
+            # The whole input folder is watched, so files waiting outside the
+            # processor folders are reported on every write
+            self.logger.debug(f"Skipping '{file_path}': no processor for its folder.")
+            return
+
+        # No size or mtime yet, so the next check starts the count
+        self.file_status[file_path] = (None, 0, self._scan_generation)
+        self.logger.debug(f"File '{file_path}' reported. Starting staleness check.")
+
+    def check_watched_files(self):
+        """
+        Runs one staleness check on the files reported by the file system
+        watcher, like check_for_new_files does for the files a scan finds,
+        and adds the ones that became stable to the database.
+        """
+        self._scan_generation += 1
+        generation = self._scan_generation
+        paths = list(self.file_status)
+        if self._stat_pool is None:
+            candidates = [(file_path, self._get_file_state(file_path)) for file_path in paths]
+        else:
+            candidates = list(zip(paths, self._stat_pool.map(self._get_file_state, paths)))
+        # Files reported by the watcher all have a processor
+        new_tasks = self._check_staleness(candidates, generation, set())
+        self._add_stable_tasks(new_tasks)
+        # Files that vanished since they were reported are not checked again
+        self._forget_unseen(generation)
 
     # NEW: Method to purge completed input files
     def purge_completed_inputs(self):
@@ -147,3 +397,9 @@ class FileMonitor:
                 self.db.update_task_status(task_id, 'purged')
         
         self.logger.info("Purge process finished.")
+
+    def close(self):
+        """Shuts down the stat worker pool, if one was started."""
+        if self._stat_pool is not None:
+            self._stat_pool.shutdown(wait=True)
+            self._stat_pool = None
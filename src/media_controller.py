@@ -1,25 +1,47 @@
 import os
 import json
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from processor_loader import load_processors
 
+@lru_cache(maxsize=2048)
+def _parse_params(params_str):
+    """
+    Decodes a task's processing params. All files in a folder share the same
+    params string, so decoded values are cached and shared between tasks.
+    Callers must not modify the result.
+    """
+    return json.loads(params_str)
+
 class MediaController:
     """
     Manages the processing of media tasks by loading and invoking
     the correct processor for each pending task.
+    Tasks run on a pool of worker threads so the main loop keeps monitoring
+    while FFmpeg is busy. If a wakeup event is given, it is set whenever a
+    task finishes.
     """
-    def __init__(self, config, db, debug=False):
+    def __init__(self, config, db, debug=False, wakeup=None):
         self.config = config
         self.db = db
         self.debug = debug
+        self.wakeup = wakeup
         self.logger = logging.getLogger(self.__class__.__name__)
         if self.debug:
             self.logger.setLevel(logging.DEBUG)
         else:
             self.logger.setLevel(logging.INFO)
-            
+
         self.processors = self._load_processors()
-        self.logger.info("MediaController initialized successfully.")
+        # FFmpeg does the heavy lifting in its own process, so threads are enough
+        self.concurrency = max(1, int(self.config.get('concurrency', 1)))
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix='MediaWorker')
+        # IDs of tasks that have been handed to a worker but are not finished yet
+        self._in_flight = set()
+        self._in_flight_lock = threading.Lock()
+        self.logger.info(f"MediaController initialized successfully with {self.concurrency} worker(s).")
 
     def _load_processors(self):
         """
@@ -31,40 +53,79 @@ class MediaController:
 
     def process_pending_tasks(self):
         """
-        Retrieves and processes all pending tasks from the database.
+        Retrieves all pending tasks from the database and hands the ones
+        not already queued to the worker pool. Returns without waiting.
         """
         self.logger.info("Checking for pending tasks to process...")
         pending_tasks = self.db.get_pending_tasks()
-        
+
         if not pending_tasks:
             self.logger.info("No pending tasks found.")
             return
 
         self.logger.info(f"Found {len(pending_tasks)} pending tasks.")
         for task in pending_tasks:
-            task_id, file_path, processor_name, processing_params_str, status, output_files = task
-            self.logger.info(f"Starting processing for task {task_id} on file '{file_path}'...")
-            self.logger.debug(f"Received param str : {processing_params_str}")
-            try:
-                # Deserialize params from the database
-                params = json.loads(processing_params_str)
-                self.logger.debug(f"Deserialized params for processor: {params}")
+            task_id = task[0]
+            with self._in_flight_lock:
+                if task_id in self._in_flight:
+                    continue
+                self._in_flight.add(task_id)
+            self.logger.debug(f"Queuing task {task_id} for a worker.")
+            future = self.executor.submit(self.process_one, task_id)
+            future.add_done_callback(lambda f, task_id=task_id: self._on_task_done(task_id, f))
+
+    def _on_task_done(self, task_id, future):
+        """Releases a finished task so it can be picked up again if it is retried."""
+        with self._in_flight_lock:
+            self._in_flight.discard(task_id)
+        if not future.cancelled() and future.exception():
+            self.logger.error(f"Worker for task {task_id} raised: {future.exception()}")
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def process_one(self, task_id):
+        """
+        Processes a single task with its configured processor.
+        Runs on a worker thread.
+        """
+        task = self.db.get_task(task_id)
+        if not task:
+            self.logger.error(f"Task {task_id} not found. Skipping.")
+            return
+
+        task_id, file_path, processor_name, processing_params_str, status, progress = task
+        # The task may have been picked up, finished or purged since it was queued
+        if status != 'pending':
+            self.logger.debug(f"Task {task_id} is '{status}', not pending. Skipping.")
+            return
+        self.logger.info(f"Starting processing for task {task_id} on file '{file_path}'...")
+        self.logger.debug(f"Received param str : {processing_params_str}")
+        try:
+            # Deserialize params from the database
+            params = _parse_params(processing_params_str)
+            self.logger.debug(f"Deserialized params for processor: {params}")
 
-                processor = self.processors.get(processor_name)
-                if processor:
-                    output_files = processor.process(file_path, task_id, params)
+            processor = self.processors.get(processor_name)
+            if processor:
+                output_files = processor.process(file_path, task_id, params)
 
-                    if output_files:
-                        self.db.update_task_status(task_id, 'completed', output_files)
-                        self.logger.info(f"Task {task_id} completed successfully.")
-                    else:
-                        self.db.update_task_status(task_id, 'failed')
-                        self.logger.error(f"Processor '{processor_name}' failed to process the file.")
+                if output_files:
+                    self.db.update_task_status(task_id, 'completed', output_files=output_files)
+                    self.logger.info(f"Task {task_id} completed successfully.")
                 else:
                     self.db.update_task_status(task_id, 'failed')
-                    self.logger.error(f"Processor '{processor_name}' not found. Skipping task {task_id}.")
-
-            except Exception as e:
+                    self.logger.error(f"Processor '{processor_name}' failed to process the file.")
+            else:
                 self.db.update_task_status(task_id, 'failed')
-                self.logger.error(f"Unrecoverable error during processing of task {task_id}: {e}")
+                self.logger.error(f"Processor '{processor_name}' not found. Skipping task {task_id}.")
+
+        except Exception as e:
+            self.db.update_task_status(task_id, 'failed')
+            self.logger.error(f"Unrecoverable error during processing of task {task_id}: {e}")
 
+    def shutdown(self, wait=True, cancel_pending=True):
+        """
+        Stops the worker pool. Unless cancel_pending is False, tasks that
+        have not started yet are dropped and stay pending for the next run.
+        """
+        self.executor.shutdown(wait=wait, cancel_futures=cancel_pending)
@@ -1,8 +1,32 @@
 import os
+import sys
 import json
 import logging
 from importlib import import_module
 
+# Package the processor modules live in. It is importable because the
+# project root is on the system path.
+PROCESSOR_PACKAGE = 'src.processors'
+
+# Processor classes already resolved, keyed by module name
+_CLASS_CACHE = {}
+
+def get_processor_class(module_name):
+    """
+    Returns the processor class defined in the processor package's <module_name>.
+    The class name is derived from the module name, e.g. hevc_scale_processor
+    becomes HevcScaleProcessor. Resolved classes are cached.
+    """
+    ProcessorClass = _CLASS_CACHE.get(module_name)
+    if ProcessorClass is None:
+        class_name = "".join(x.capitalize() for x in module_name.split('_'))
+        # Imported relative to the package, so sys.path is never touched and
+        # repeated imports come straight from sys.modules
+        module = import_module(f".{module_name}", package=PROCESSOR_PACKAGE)
+        ProcessorClass = getattr(module, class_name)
+        _CLASS_CACHE[module_name] = ProcessorClass
+    return ProcessorClass
+
 def load_processors(config, db, debug=False):
     """
     Dynamically loads processor classes based on the configuration file.
@@ -24,16 +48,9 @@ def load_processors(config, db, debug=False):
     
     for proc in config.get('processors', []):
         try:
-            module_name = proc['processor']
-            # Corrected logic to derive class name from module name
-            class_name_parts = [x.capitalize() for x in module_name.split('_')]
-            class_name = "".join(class_name_parts)
-            
-            # The full module path is relative to the directory on the system path (which is the project root)
-            module = import_module(f"src.processors.{module_name}")
-            ProcessorClass = getattr(module, class_name)
-            
-            loaded_processors[proc['name']] = ProcessorClass(config=config, db=db, debug=debug)
+            ProcessorClass = get_processor_class(proc['processor'])
+            # Interned, so lookups with the configured name compare by identity
+            loaded_processors[sys.intern(proc['name'])] = ProcessorClass(config=config, db=db, debug=debug)
             logger.debug(f"Processor '{proc['name']}' loaded successfully.")
         except Exception as e:
             logger.error(f"Error loading processor '{proc['name']}': {e}")
@@ -1,11 +1,176 @@
 import os
 import json
+import logging
+import shlex
+import subprocess
+import tempfile
+import threading
 from abc import ABC, abstractmethod
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import asdict, dataclass
+from functools import lru_cache
+
+# PyAV is optional: with it, files are probed in-process instead of by
+# starting an ffprobe process for each one
+try:
+    import av
+except ImportError:
+    av = None
+
+# Added to every FFmpeg run: never read the terminal, only print errors, and
+# write key=value progress updates such as out_time_us=... to stdout
+FFMPEG_PROGRESS_OPTIONS = ('-nostdin', '-hide_banner', '-loglevel', 'error', '-progress', 'pipe:1')
+
+# FFmpeg's progress output is read in blocks of this many bytes
+READ_CHUNK_SIZE = 65536
+
+# How many of FFmpeg's last stderr lines are kept for the error message
+STDERR_TAIL_LINES = 500
+
+@dataclass(frozen=True)
+class MediaInfo:
+    """Stream metadata of a media file, as reported by ffprobe."""
+    duration: float = None
+    fps: float = None
+    width: int = None
+    height: int = None
+    vcodec: str = None
+    acodec: str = None
+
+    @classmethod
+    def from_ffprobe(cls, probe):
+        """Builds a MediaInfo from ffprobe's JSON output for the format and streams."""
+        streams = probe.get('streams', [])
+        video = next((stream for stream in streams if stream.get('codec_type') == 'video'), {})
+        audio = next((stream for stream in streams if stream.get('codec_type') == 'audio'), {})
+        duration = probe.get('format', {}).get('duration') or video.get('duration')
+        fps = None
+        num, _, den = video.get('avg_frame_rate', '').partition('/')
+        if num and den and float(den):
+            fps = float(num) / float(den)
+        return cls(
+            duration=float(duration) if duration else None,
+            fps=fps,
+            width=video.get('width'),
+            height=video.get('height'),
+            vcodec=video.get('codec_name'),
+            acodec=audio.get('codec_name'),
+        )
+
+    @classmethod
+    def from_container(cls, container):
+        """Builds a MediaInfo from a file opened with PyAV."""
+        video = next(iter(container.streams.video), None)
+        audio = next(iter(container.streams.audio), None)
+        duration = container.duration / av.time_base if container.duration else None
+        if duration is None and video is not None and video.duration:
+            duration = float(video.duration * video.time_base)
+        fps = float(video.average_rate) if video is not None and video.average_rate else None
+        return cls(
+            duration=duration,
+            fps=fps,
+            width=video.codec_context.width if video is not None else None,
+            height=video.codec_context.height if video is not None else None,
+            vcodec=video.codec_context.name if video is not None else None,
+            acodec=audio.codec_context.name if audio is not None else None,
+        )
+
+def _read_media_info(input_path):
+    """
+    Reads a file's MediaInfo with PyAV if it is installed, or with a single
+    ffprobe call otherwise. Files PyAV cannot open are handed to ffprobe,
+    which also reports the error if the file is unreadable.
+    """
+    if av is not None:
+        try:
+            with av.open(input_path) as container:
+                return MediaInfo.from_container(container)
+        except (av.error.FFmpegError, OSError):
+            pass
+    cmd = ['ffprobe', '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', input_path]
+    result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+    return MediaInfo.from_ffprobe(json.loads(result.stdout))
+
+@lru_cache(maxsize=256)
+def _probe_media(db, input_path, mtime_ns, size):
+    """
+    Returns the MediaInfo of a media file, probing it only once. The
+    file's mtime and size are part of the cache key, so a changed file is
+    probed again. Results are also kept in the database so they survive
+    restarts. Raises if ffprobe fails, so failures are not cached.
+    """
+    info = db.get_probe_info(input_path, mtime_ns, size)
+    if info is None:
+        info = asdict(_read_media_info(input_path))
+        db.save_probe_info(input_path, mtime_ns, size, info)
+    return MediaInfo(**info)
+
+# Probes that run while FFmpeg is already starting up
+_probe_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='MediaProbe')
+
+# Hardware HEVC encoders in order of preference when the encoder is 'auto'
+HEVC_HARDWARE_ENCODERS = ('hevc_nvenc', 'hevc_qsv', 'hevc_vaapi')
+
+# Encoders that decode and scale on the GPU, so frames never go back to
+# system memory: the -hwaccel API and the matching scale filter
+HWACCEL_SCALERS = {
+    'hevc_nvenc': ('cuda', 'scale_cuda=-2:{}'),
+    'hevc_vaapi': ('vaapi', 'scale_vaapi=w=-2:h={}'),
+}
+
+# Hardware encoders that failed in this run. Later tasks go straight to
+# libx265 instead of failing on the same encoder again.
+_failed_encoders = set()
+
+# FFmpeg errors showing that the hardware encoder or its device could not be
+# set up at all, rather than that one input could not be encoded
+HARDWARE_INIT_ERRORS = (
+    'Cannot load libcuda', 'Cannot load nvcuda', 'No NVENC capable devices found',
+    'OpenEncodeSessionEx failed', 'InitializeEncoder failed',
+    'Failed to initialise VAAPI connection', 'No VA display found',
+    'Error initializing an internal MFX session', 'Error creating a MFX session',
+    'Device creation failed', 'Unknown encoder',
+)
+
+# Exit code of an FFmpeg that was stopped by a signal, e.g. Ctrl-C
+FFMPEG_INTERRUPTED_EXIT = 255
+
+# Limits concurrent hardware encodes, since GPUs cap encoder sessions.
+# Created on first use from the hardware_encoder_sessions setting.
+_hardware_sessions = None
+_hardware_sessions_lock = threading.Lock()
+
+@lru_cache(maxsize=1)
+def get_available_encoders():
+    """Returns the names of the encoders this FFmpeg build supports."""
+    try:
+        result = subprocess.run(['ffmpeg', '-hide_banner', '-encoders'], capture_output=True, text=True, check=True)
+    except (subprocess.CalledProcessError, OSError):
+        return frozenset()
+    encoders = set()
+    for line in result.stdout.splitlines():
+        # Encoder lines look like ' V....D libx265   libx265 H.265 / HEVC'
+        parts = line.split()
+        if len(parts) >= 2 and len(parts[0]) == 6:
+            encoders.add(parts[1])
+    return frozenset(encoders)
+
+def _get_hardware_sessions(config):
+    """Returns the semaphore shared by all hardware encodes."""
+    global _hardware_sessions
+    with _hardware_sessions_lock:
+        if _hardware_sessions is None:
+            _hardware_sessions = threading.BoundedSemaphore(max(1, int(config.get('hardware_encoder_sessions', 2))))
+        return _hardware_sessions
 
 class Processor(ABC):
     """
     Base class for all media processors.
     """
+    # Output folders already created in this run, shared by all processors
+    _ensured_dirs = set()
+
     def __init__(self, config, db, debug=False):
         self.config = config
         self.db = db
@@ -23,9 +188,11 @@ class Processor(ABC):
                 return proc
         raise ValueError(f"Processor configuration for '{processor_name}' not found.")
 
-    def _get_output_path(self, input_path, output_path_suffix, output_extension):
+    def _get_output_path(self, input_path, output_path_suffix, output_extension, name_suffix=''):
         """
         Constructs the output file path based on the input path and configured outputs.
+        name_suffix is appended to the file name before the extension.
+        The output folder is created once per run.
         """
         # Get the output parent folder from the main config
         output_parent_folder = self.config.get('output_parent_folder')
@@ -37,12 +204,240 @@ class Processor(ABC):
 
         # Construct the output folder path
         output_folder = os.path.join(output_parent_folder, output_path_suffix)
-        os.makedirs(output_folder, exist_ok=True)
+        if output_folder not in self._ensured_dirs:
+            os.makedirs(output_folder, exist_ok=True)
+            self._ensured_dirs.add(output_folder)
 
         # Construct the final output path
-        output_filename = f"{filename}.{output_extension}"
+        output_filename = f"{filename}{name_suffix}.{output_extension}"
         return os.path.join(output_folder, output_filename)
 
+    def _get_media_info(self, input_path):
+        """
+        Gets the stream metadata of a media file using ffprobe, reusing
+        earlier results for the same file. Returns None if probing fails.
+        """
+        try:
+            stat = os.stat(input_path)
+            return _probe_media(self.db, input_path, stat.st_mtime_ns, stat.st_size)
+        except (subprocess.CalledProcessError, OSError, ValueError) as e:
+            self.logger.error(f"Failed to probe {input_path}: {e}")
+            return None
+
+    def _get_video_duration(self, input_path):
+        """Gets video duration using ffprobe."""
+        media_info = self._get_media_info(input_path)
+        return media_info.duration if media_info else None
+
+    def _start_duration_probe(self, input_path):
+        """
+        Starts probing the video duration in the background and returns a
+        future for it, so FFmpeg can be started without waiting for ffprobe.
+        """
+        return _probe_executor.submit(self._get_video_duration, input_path)
+
+    def _set_process_priority(self, pid):
+        """
+        Lowers the scheduling priority of an FFmpeg process to the ffmpeg_nice
+        setting, and pins it to the CPUs in ffmpeg_cpu_affinity if given, so
+        encodes don't starve the main loop of CPU time.
+        This is done after the process has started rather than in a
+        preexec_fn, which is not safe with several worker threads.
+        """
+        nice = self.config.get('ffmpeg_nice', 10)
+        cpus = self.config.get('ffmpeg_cpu_affinity')
+        try:
+            if nice and hasattr(os, 'setpriority'):
+                os.setpriority(os.PRIO_PROCESS, pid, int(nice))
+            if cpus and hasattr(os, 'sched_setaffinity'):
+                os.sched_setaffinity(pid, cpus)
+        except OSError as e:
+            self.logger.warning(f"Could not set the priority of FFmpeg process {pid}: {e}")
+
+    def _run_ffmpeg(self, command, task_id, duration):
+        """
+        Runs an FFmpeg command and records its progress for the task.
+        FFmpeg writes machine-readable progress to stdout, which is read in
+        large blocks and split locally instead of line by line. With
+        -loglevel error, stderr only carries errors. It goes to a temporary
+        file, so it can never fill a pipe while stdout is being read.
+        duration may be a future from _start_duration_probe. Progress is then
+        recorded once the probe has finished, and not at all if it failed.
+        Returns the return code and, if FFmpeg failed, its stderr output.
+        """
+        command = [command[0], *FFMPEG_PROGRESS_OPTIONS, *command[1:]]
+        # The command line is only put together when it is going to be logged
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.logger.debug(f"FFmpeg command: {shlex.join(command)}")
+        with tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr, bufsize=READ_CHUNK_SIZE)
+            self._set_process_priority(process.pid)
+            pending = b''
+            duration_future = duration if isinstance(duration, Future) else None
+            # Progress is worked out in whole microseconds and percents
+            duration_us = None if duration_future else int(duration * 1000000) if duration else 0
+            try:
+                for chunk in iter(lambda: process.stdout.read1(READ_CHUNK_SIZE), b''):
+                    lines = (pending + chunk).split(b'\n')
+                    # The last piece may be an incomplete line
+                    pending = lines.pop()
+                    if duration_us is None:
+                        if not duration_future.done():
+                            continue
+                        try:
+                            duration = duration_future.result()
+                        except Exception as e:
+                            self.logger.warning(f"Could not probe the duration, so progress is not recorded: {e}")
+                            duration = None
+                        duration_us = int(duration * 1000000) if duration else 0
+                    if not duration_us:
+                        continue
+                    # Only the newest update in the block is worth recording
+                    for line in reversed(lines):
+                        if line.startswith(b'out_time_us='):
+                            current_us = line[12:]
+                            # FFmpeg reports N/A until the first frame is written
+                            if not current_us.isdigit():
+                                break
+                            # 100% is only recorded once the task has completed
+                            progress = min(int(current_us) * 100 // duration_us, 99)
+                            # The database throttles how often progress is written
+                            self.db.update_task_progress(task_id, progress)
+                            break
+
+                process.wait()
+            finally:
+                # If reading fails, FFmpeg is stopped instead of being left running
+                if process.returncode is None:
+                    process.kill()
+                    process.wait()
+            if process.returncode == 0:
+                return 0, ''
+            self.logger.error(f"FFmpeg command was: {shlex.join(command)}")
+            # Only the end of stderr is kept, which is where FFmpeg reports errors
+            stderr.seek(0)
+            tail = deque(stderr, maxlen=STDERR_TAIL_LINES)
+        return process.returncode, b''.join(tail).decode('utf-8', 'replace').strip()
+
+    def _get_thread_options(self):
+        """
+        Returns the FFmpeg -threads option for the encoder. Uses the processor's
+        or the global ffmpeg_threads setting. Otherwise, with several tasks
+        running at once, the cores are split between them, since a single
+        encode rarely keeps all of them busy. A lone task lets FFmpeg decide.
+        """
+        threads = self.processor_config.get('ffmpeg_threads', self.config.get('ffmpeg_threads'))
+        if threads is None:
+            concurrency = max(1, int(self.config.get('concurrency', 1)))
+            if concurrency == 1:
+                return []
+            threads = max(1, (os.cpu_count() or 1) // concurrency)
+        return ['-threads', str(threads)]
+
+    def _select_hevc_encoder(self):
+        """
+        Returns the HEVC encoder to use. With 'auto' in the processor's encoder
+        setting, the first hardware encoder FFmpeg supports is picked.
+        """
+        encoder = self.processor_config.get('encoder', 'libx265')
+        if encoder == 'auto':
+            available = get_available_encoders()
+            encoder = next((name for name in HEVC_HARDWARE_ENCODERS if name in available), 'libx265')
+        if encoder in _failed_encoders:
+            return 'libx265'
+        return encoder
+
+    def _get_hevc_encoder_options(self, encoder, bitrate=None):
+        """
+        Returns the video and audio encoding options for one HEVC output, at a
+        bitrate in kbit/s if given and otherwise at the configured crf. Audio
+        is AAC with the volume doubled.
+        """
+        proc_config = self.processor_config
+        quality = str(proc_config.get('crf', 28))
+        options = ['-c:v', encoder]
+        if encoder == 'hevc_nvenc':
+            options += ['-preset', 'p4', '-rc', 'vbr']
+            options += ['-b:v', f'{bitrate}k'] if bitrate else ['-cq', quality]
+        elif encoder == 'hevc_qsv':
+            options += ['-b:v', f'{bitrate}k'] if bitrate else ['-global_quality', quality]
+        elif encoder == 'hevc_vaapi':
+            options += ['-b:v', f'{bitrate}k'] if bitrate else ['-qp', quality]
+        else:
+            options += ['-b:v', f'{bitrate}k'] if bitrate else ['-crf', quality]
+            options += ['-preset', proc_config.get('preset', 'faster')]
+            if proc_config.get('x265_params'):
+                options += ['-x265-params', proc_config['x265_params']]
+
+        options += self._get_thread_options()
+        options += ['-c:a', 'aac', '-af', 'volume=2.0']
+        return options
+
+    def _build_hevc_command(self, input_path, outputs, encoder, bitrate=None):
+        """
+        Builds an FFmpeg command encoding the input to HEVC with the given
+        encoder. outputs is a list of (output_path, height) pairs, where a
+        height of None keeps the input's dimensions. Several outputs share a
+        single decode of the input, which is split between the scalers.
+        """
+        # -y overwrites existing outputs instead of stopping at FFmpeg's prompt
+        command = ['ffmpeg', '-y']
+        if encoder in HWACCEL_SCALERS:
+            hwaccel, scale_filter = HWACCEL_SCALERS[encoder]
+            # Decode on the GPU and keep frames there for scaling and encoding
+            command += ['-hwaccel', hwaccel, '-hwaccel_output_format', hwaccel]
+        else:
+            scale_filter = 'scale=-2:{}'
+        command += ['-i', input_path]
+        encoder_options = self._get_hevc_encoder_options(encoder, bitrate=bitrate)
+
+        if len(outputs) == 1:
+            output_path, height = outputs[0]
+            if height:
+                command += ['-vf', scale_filter.format(height)]
+            return command + encoder_options + [output_path]
+
+        split_labels = ''.join(f'[v{i}]' for i in range(len(outputs)))
+        graph = [f'[0:v]split={len(outputs)}{split_labels}']
+        for i, (_, height) in enumerate(outputs):
+            if height:
+                graph.append(f'[v{i}]{scale_filter.format(height)}[o{i}]')
+            else:
+                graph.append(f'[v{i}]null[o{i}]')
+        command += ['-filter_complex', ';'.join(graph)]
+        for i, (output_path, _) in enumerate(outputs):
+            command += ['-map', f'[o{i}]', '-map', '0:a?'] + encoder_options + [output_path]
+        return command
+
+    def _run_hevc_ffmpeg(self, input_path, outputs, task_id, duration, bitrate=None):
+        """
+        Encodes the input to HEVC and records progress for the task. outputs
+        is a list of (output_path, height) pairs, all written by one FFmpeg
+        run. A failed hardware encode is retried once with libx265, unless
+        FFmpeg was interrupted. The hardware encoder is only given up on for
+        later tasks if it could not be set up, so one broken input or a
+        transient error does not turn it off for the rest of the run.
+        Returns the return code and, if FFmpeg failed, its stderr output.
+        """
+        encoder = self._select_hevc_encoder()
+        command = self._build_hevc_command(input_path, outputs, encoder, bitrate=bitrate)
+        if encoder == 'libx265':
+            return self._run_ffmpeg(command, task_id, duration)
+
+        with _get_hardware_sessions(self.config):
+            returncode, output = self._run_ffmpeg(command, task_id, duration)
+        if returncode == 0 or returncode < 0 or returncode == FFMPEG_INTERRUPTED_EXIT:
+            return returncode, output
+
+        self.logger.warning(f"Hardware encoder '{encoder}' failed for '{input_path}'. Falling back to libx265.")
+        init_failed = any(error in output for error in HARDWARE_INIT_ERRORS)
+        command = self._build_hevc_command(input_path, outputs, 'libx265', bitrate=bitrate)
+        returncode, output = self._run_ffmpeg(command, task_id, duration)
+        if init_failed:
+            self.logger.warning(f"Using libx265 instead of '{encoder}' for the rest of this run.")
+            _failed_encoders.add(encoder)
+        return returncode, output
+
     @abstractmethod
     def process(self, input_path, task_id, params):
         """
@@ -52,6 +447,7 @@ class Processor(ABC):
             input_path (str): The path to the input media file.
             task_id (int): The ID of the task in the database.
             params (list): A list of strings containing instructions from the folder path.
+                The list is shared with other tasks from the same folder and must not be modified.
         """
         pass
 
@@ -1,10 +1,12 @@
-import subprocess
-import os
-import re
-import json
 import logging
 from . import Processor
 
+# Joins several target heights in one folder name, e.g. 1080+720
+HEIGHT_SEPARATOR = '+'
+# Target heights outside this range are rejected
+MIN_HEIGHT = 16
+MAX_HEIGHT = 4320
+
 class HevcScaleProcessor(Processor):
     def __init__(self, config, db, debug=False):
         super().__init__(config, db, debug)
@@ -15,86 +17,97 @@ class HevcScaleProcessor(Processor):
             self.logger.setLevel(logging.INFO)
         self.logger.debug("HevcScaleProcessor initialized.")
 
-    def _get_video_duration(self, input_path):
-        """Gets video duration using ffprobe."""
-        try:
-            cmd = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of',
-                   'default=noprint_wrappers=1:nokey=1', input_path]
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-            return float(result.stdout)
-        except (subprocess.CalledProcessError, FileNotFoundError, ValueError) as e:
-            self.logger.error(f"Failed to get video duration for {input_path}: {e}")
-            return None
+    def _get_heights(self, params):
+        """
+        Returns the target heights from the first param. Several heights are
+        joined with '+', e.g. 1080+720+480. Further folders below it are not
+        heights. Raises ValueError for a height outside MIN_HEIGHT..MAX_HEIGHT.
+        """
+        if not params or not params[0]:
+            return []
+        heights = params[0].split(HEIGHT_SEPARATOR)
+        for height in heights:
+            if not height.isdigit() or not MIN_HEIGHT <= int(height) <= MAX_HEIGHT:
+                raise ValueError(f"Invalid height '{height}' in processing params. Heights must be between {MIN_HEIGHT} and {MAX_HEIGHT}.")
+        return heights
+
+    def _get_scaled_outputs(self, input_path, heights, output_path_suffix, output_extension):
+        """
+        Returns (output_path, height) pairs for the heights. Output names get
+        a _<height>p suffix when there is more than one height.
+        """
+        if len(heights) == 1:
+            return [(self._get_output_path(input_path, output_path_suffix, output_extension), heights[0])]
+        return [
+            (self._get_output_path(input_path, output_path_suffix, output_extension, name_suffix=f"_{height}p"), height)
+            for height in heights
+        ]
+
+    def _is_already_scaled(self, media_info, heights):
+        """Checks whether the input is HEVC at the only target height already."""
+        return (
+            media_info is not None
+            and media_info.vcodec == 'hevc'
+            and len(heights) == 1
+            and str(media_info.height) == heights[0]
+        )
+
+    def _build_copy_command(self, input_path, output_path):
+        """
+        Builds an FFmpeg command that copies the video stream unchanged and
+        only re-encodes the audio with the volume doubled.
+        """
+        return [
+            'ffmpeg', '-y',
+            '-i', input_path,
+            '-c:v', 'copy',
+            '-c:a', 'aac',
+            '-af', 'volume=2.0',
+            output_path
+        ]
 
     def process(self, input_path, task_id, params):
         self.logger.debug(f"Received input_path: {input_path}")
         self.logger.debug(f"Received params: {params}")
 
         # Retrieve parameters from the dictionary
-        height = params[0]
+        heights = self._get_heights(params)
         output_path_suffix = self.processor_config.get('output_path')
         output_extension = self.processor_config.get('output_file_extension')
         
         # Ensure mandatory parameters are provided
-        if not height:
+        if not heights or not all(heights):
             raise ValueError("Height parameter is missing from processing params.")
         if not output_path_suffix:
             raise ValueError("Output path prefix is missing from processing params.")
         if not output_extension:
             raise ValueError("Output file extension is missing from processing params.")
         
-        # Construct the output path and command
-        output_path = self._get_output_path(input_path, output_path_suffix, output_extension)
-        self.logger.debug(f"Final output path for FFmpeg: {output_path}")
-        # Delete the output file if it already exists to prevent FFmpeg from hanging
-        if os.path.exists(output_path):
-            self.logger.debug(f"Output file '{output_path}' already exists. Deleting it.")
-            os.remove(output_path)
-        output_path_db = [output_path]
-        self.db.update_task_status(task_id, 'processing')
-        self.db.update_task_output_files(task_id,json.dumps(output_path_db))
+        # Construct the output paths and command
+        outputs = self._get_scaled_outputs(input_path, heights, output_path_suffix, output_extension)
+        output_paths = [output_path for output_path, _ in outputs]
+        self.logger.debug(f"Final output paths for FFmpeg: {output_paths}")
+        self.db.update_task_status(task_id, 'processing', output_files=output_paths)
 
-        command = [
-            'ffmpeg',
-            '-i', input_path,
-            '-vf', f'scale=-2:{height}',
-            '-c:v', 'libx265',
-            '-crf', '28',
-            '-preset', 'fast',
-            '-c:a', 'aac',
-            '-af', 'volume=2.0',
-            output_path
-        ]
+        # Run FFmpeg once for all heights and report progress
+        media_info = self._get_media_info(input_path)
+        duration = media_info.duration if media_info else None
         
-        # Run FFmpeg and report progress
-        duration = self._get_video_duration(input_path)
-        
-        self.logger.debug(f"FFmpeg command: {' '.join(command)}")
-        output_lines = []            
         try:
-            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            for line in iter(process.stderr.readline, ''):
-                output_lines.append(line)
-                time_match = re.search(r"time=(\d{2}):(\d{2}):(\d{2})\.(\d{2})", line)
-                if time_match and duration:
-                    h, m, s, cs = map(int, time_match.groups())
-                    current_time = h * 3600 + m * 60 + s + cs / 100
-                    progress = (current_time / duration) * 100
-                    self.logger.debug(f"Calculated progress: {progress:.2f}%")
-                    self.db.update_task_progress(task_id, progress)
-
-            process.wait()
+            if self._is_already_scaled(media_info, heights):
+                self.logger.info(f"'{input_path}' is already HEVC at {heights[0]}p. Copying the video stream.")
+                returncode, output = self._run_ffmpeg(self._build_copy_command(input_path, output_paths[0]), task_id, duration)
+            else:
+                returncode, output = self._run_hevc_ffmpeg(input_path, outputs, task_id, duration)
 
-            if process.returncode != 0:
-                stdout, stderr = process.communicate()
-                self.logger.error(f"FFmpeg process for '{input_path}' failed with return code {process.returncode}.")
-                self.logger.error(f"STDOUT: {stdout}")
-                self.logger.error(f"STDERR: {stderr}")
-                self.db.update_task_status(task_id, 'failed', error_message=''.join(output_lines))
+            if returncode != 0:
+                self.logger.error(f"FFmpeg process for '{input_path}' failed with return code {returncode}.")
+                self.logger.error(f"STDERR: {output}")
+                self.db.update_task_status(task_id, 'failed', error_message=output)
                 return None
             
             self.logger.info(f"FFmpeg process for '{input_path}' completed successfully.")
-            return [output_path]
+            return output_paths
             
         except FileNotFoundError:
             self.logger.error(f"FFmpeg or FFprobe not found. Please ensure they are installed and in your system's PATH.")
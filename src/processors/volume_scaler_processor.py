@@ -1,9 +1,4 @@
-import os
-import re
-import json
-import subprocess
 import logging
-import time
 from . import Processor
 
 class VolumeScalerProcessor(Processor):
@@ -19,17 +14,6 @@ class VolumeScalerProcessor(Processor):
             self.logger.setLevel(logging.INFO)
         self.logger.debug("VolumeScalerProcessor initialized.")
 
-    def _get_video_duration(self, input_path):
-        """Gets video duration using ffprobe."""
-        try:
-            cmd = ['ffprobe', '-v', 'error', '-show_entries', 'format=duration', '-of',
-                   'default=noprint_wrappers=1:nokey=1', input_path]
-            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-            return float(result.stdout)
-        except (subprocess.CalledProcessError, FileNotFoundError, ValueError) as e:
-            self.logger.error(f"Failed to get video duration for {input_path}: {e}")
-            return None
-
     def process(self, input_path, task_id, params):
         self.logger.debug(f"Received input_path: {input_path}")
         self.logger.debug(f"Received params: {params}")
@@ -65,55 +49,39 @@ class VolumeScalerProcessor(Processor):
         output_path = self._get_output_path(input_path, output_path_suffix, output_extension)
         self.logger.debug(f"Final output path for FFmpeg: {output_path}")
 
-        # Delete the output file if it exists to prevent FFmpeg from hanging
-        if os.path.exists(output_path):
-            self.logger.debug(f"Output file '{output_path}' already exists. Deleting it.")
-            os.remove(output_path)
         output_path_db = [output_path]
         
         # Update the database with the processing status and output file path
-        self.db.update_task_status(task_id, 'processing')
-        self.db.update_task_output_files(task_id, json.dumps(output_path_db))
+        self.db.update_task_status(task_id, 'processing', output_files=output_path_db)
 
-        # Build FFmpeg command
-        command = [
-            'ffmpeg',
-            '-i', input_path,
-            '-af', f"volume={volume_scale}",
-            '-c:v', 'copy',
-            '-c:a', 'aac',
-            output_path
-        ]
-        
-        # Run FFmpeg and report progress
-        duration = self._get_video_duration(input_path)
+        media_info = self._get_media_info(input_path)
+        duration = media_info.duration if media_info else None
+
+        # Build FFmpeg command. -y overwrites an existing output instead of prompting
+        if volume_scale == 1.0 and media_info and media_info.acodec == 'aac':
+            # The audio is already AAC at the requested volume, so nothing needs re-encoding
+            command = ['ffmpeg', '-y', '-i', input_path, '-c', 'copy', output_path]
+        else:
+            command = [
+                'ffmpeg',
+                '-y',
+                '-i', input_path,
+                '-af', f"volume={volume_scale}",
+                '-c:v', 'copy',
+                '-c:a', 'aac',
+                *self._get_thread_options(),
+                output_path
+            ]
         
-        self.logger.debug(f"FFmpeg command: {' '.join(command)}")
-        output_lines = []
         try:
-            process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-            for line in iter(process.stderr.readline, ''):
-                output_lines.append(line)
-                time_match = re.search(r"time=(\d{2}):(\d{2}):(\d{2})\.(\d{2})", line)
-                if time_match and duration:
-                    h, m, s, cs = map(int, time_match.groups())
-                    current_time = h * 3600 + m * 60 + s + cs / 100
-                    progress = (current_time / duration) * 100
-                    if progress > 100: progress = 99.99
-                    self.logger.debug(f"Calculated progress: {progress:.2f}%")
-                    self.db.update_task_progress(task_id, progress)
-
-            process.wait()
+            returncode, output = self._run_ffmpeg(command, task_id, duration)
 
-            if process.returncode != 0:
-                stdout, stderr = process.communicate()
-                self.logger.error(f"FFmpeg process for '{input_path}' failed with return code {process.returncode}.")
-                self.logger.error(f"STDOUT: {stdout}")
-                self.logger.error(f"STDERR: {stderr}")
-                self.db.update_task_status(task_id, 'failed', error_message=''.join(output_lines))
+            if returncode != 0:
+                self.logger.error(f"FFmpeg process for '{input_path}' failed with return code {returncode}.")
+                self.logger.error(f"STDERR: {output}")
+                self.db.update_task_status(task_id, 'failed', error_message=output)
                 return None
             
-            self.db.update_task_status(task_id, 'completed')
             self.logger.info(f"FFmpeg process for '{input_path}' completed successfully.")
             return [output_path]
             
@@ -1,58 +1,296 @@
 import time
 import os
 import argparse
+import atexit
 import json
 import logging
+import logging.config
+import logging.handlers
+import queue
+import signal
+import sqlite3
+import subprocess
 import sys
-
-# Add the src directory to the system path to allow absolute imports
-sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), 'src')))
-
-# Import all core components for testing
-from database import Database
-from file_monitor import FileMonitor
-from media_controller import MediaController
-from processor_loader import load_processors
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from types import MappingProxyType
+
+# orjson is optional: it parses the config faster than the json module
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Add the src directory to the system path to allow absolute imports.
+# main.py, imported by the FileMonitor test, adds the same directory, so it
+# is only added once.
+SRC_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'src'))
+if SRC_DIR not in sys.path:
+    sys.path.append(SRC_DIR)
+
+# Test fixtures live next to this script
+TESTS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), 'tests'))
+MOCK_VIDEO_PATH = os.path.join(TESTS_DIR, 'sample_video.mp4')
+MOCK_PURGE_PATH = os.path.join(TESTS_DIR, 'mock_file_to_purge.mp4')
+# Params of the purge test's mock task, already encoded as stored
+MOCK_PURGE_PARAMS = '["360"]'
+
+# The components under test are imported by the tests that use them, so a
+# run only pays for the imports of the components it tests
+
+# Longest wait between FileMonitor test cycles. A close event on a watched
+# folder ends the wait early.
+MONITOR_TEST_WAIT = 0.25
+
+# Contents of the file the FileMonitor test places in the input folder
+MOCK_TRANSFER_DATA = b'this is a test file to simulate transfer'
+
+# Set on Ctrl-C during a test in STOPPABLE_TESTS, so the FileMonitor test
+# stops after its current cycle instead of running the remaining ones
+stop_event = threading.Event()
+
+# Set by --keep_fixtures: fixture files that exist are used as they are
+keep_fixtures = False
+
+def load_processor(config, db, name):
+    """
+    Instantiates only the named processor, instead of every configured one
+    as load_processors does. Returns None if no processor has that name.
+    """
+    from processor_loader import get_processor_class
+    for proc in config.get('processors', []):
+        if proc['name'] == name:
+            # Classes are cached by the loader, so each module is imported once per run
+            return get_processor_class(proc['processor'])(config=config, db=db, debug=True)
+    return None
+
+# The Database shared by all tests of a run, see get_test_db
+_test_db = None
+_test_db_lock = threading.Lock()
+
+def get_test_db(config):
+    """
+    Returns the Database shared by all tests of this run, opening and
+    initializing it on first use. Raises RuntimeError if it cannot be
+    initialized, or OSError if its directory cannot be created. Tests must
+    not close it; main does once every test has finished.
+    """
+    from database import Database
+    global _test_db
+    with _test_db_lock:
+        if _test_db is None:
+            db = Database(config=config, debug=True)
+            if not db.initialize_database():
+                raise RuntimeError(f"Could not initialize the database at {db.db_path}.")
+            _test_db = db
+        return _test_db
+
+def create_mock_video(mock_video_path, logger):
+    """
+    Creates a 5 second 1280x720 test clip. It is encoded on the GPU with NVENC
+    if FFmpeg supports it, and with the fastest libx264 settings otherwise.
+    FFmpeg lists NVENC even without an NVIDIA GPU, so a failed NVENC encode
+    is retried with libx264. The clip is written to a temporary file next to
+    mock_video_path and only moved into place once FFmpeg succeeds, so an
+    interrupted run never leaves a truncated clip to be reused. Returns
+    whether FFmpeg succeeded.
+    """
+    folder, name = os.path.split(mock_video_path)
+    os.makedirs(folder, exist_ok=True)
+    # The extension tells FFmpeg which container to write
+    fd, temp_path = tempfile.mkstemp(dir=folder, prefix=f".{name}.", suffix=os.path.splitext(name)[1])
+    os.close(fd)
+    try:
+        # mkstemp creates the file readable by its owner only
+        os.chmod(temp_path, 0o644)
+        if _encode_mock_video(temp_path, logger):
+            os.replace(temp_path, mock_video_path)
+            return True
+        return False
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def _encode_mock_video(output_path, logger):
+    """Runs FFmpeg for create_mock_video. Returns whether it succeeded."""
+    from src.processors import get_available_encoders
+    software_options = ['-c:v', 'libx264', '-preset', 'ultrafast', '-tune', 'zerolatency']
+    attempts = [software_options]
+    if 'h264_nvenc' in get_available_encoders():
+        attempts.insert(0, ['-c:v', 'h264_nvenc', '-preset', 'p1'])
+    for encoder_options in attempts:
+        command = [
+            'ffmpeg', '-y', '-hide_banner', '-loglevel', 'error',
+            '-f', 'lavfi', '-i', 'testsrc=size=1280x720:rate=1',
+            '-t', '5',
+            *encoder_options,
+            '-pix_fmt', 'yuv420p',
+            output_path
+        ]
+        try:
+            result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=False)
+        except OSError as e:
+            logger.error(f"Could not run FFmpeg to create the mock video: {e}")
+            return False
+        if result.returncode == 0:
+            return True
+        if encoder_options is not software_options:
+            logger.warning("NVENC failed to create the mock video. Falling back to libx264.")
+            logger.debug("FFmpeg output: %s", result.stderr.strip())
+    logger.error("FFmpeg failed to create the mock video: %s", result.stderr.strip())
+    return False
+
+def ensure_mock_video(mock_video_path, logger):
+    """
+    Makes sure the mock video exists. Its content never changes, so a clip
+    left by an earlier run is reused instead of being encoded again.
+    """
+    if os.path.isfile(mock_video_path) and os.path.getsize(mock_video_path) > 0:
+        return True
+    return create_mock_video(mock_video_path, logger)
+
+@contextmanager
+def processor_test_task(db, processor_name, params):
+    """
+    Registers the task a processor test runs, so the processor reports its
+    progress on a row of its own, and removes the row again when the block
+    exits. Tasks are unique per file path and the processor tests all read
+    the mock video, so each row is keyed by the mock video path and the
+    processor name. The row is marked as processing right away, so a
+    MediaController sharing the database never picks it up. A row left by an
+    earlier run is reused. Yields None if the task could not be registered.
+    """
+    from database import JSON_SEPARATORS
+    task_path = f"{MOCK_VIDEO_PATH}#{processor_name}"
+    task_id = None
+    try:
+        with db.transaction():
+            task_id = db.add_task(task_path, processor_name, json.dumps(params, separators=JSON_SEPARATORS))
+            if task_id is None:
+                task_id = db.get_task_id(task_path)
+            if task_id is not None:
+                db.update_task_status(task_id, 'processing')
+    except sqlite3.Error:
+        task_id = None
+    try:
+        yield task_id
+    finally:
+        if task_id is not None:
+            db.delete_task(task_id)
+
+def write_mock_file(path, payload):
+    """
+    Writes a small mock file with unbuffered os calls, reserving its space
+    up front where the platform supports it.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, len(payload))
+            except OSError:
+                # Not every file system can reserve space; the write still works
+                pass
+        os.write(fd, payload)
+    finally:
+        os.close(fd)
+
+class SecondCachedFormatter(logging.Formatter):
+    """
+    Formats asctime exactly like logging.Formatter, but calls strftime once
+    per second of log records instead of once per record. Only the log
+    listener's thread uses it, so the cache needs no lock.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cached_second = None
+        self._cached_time = None
+
+    def formatTime(self, record, datefmt=None):
+        if datefmt:
+            return super().formatTime(record, datefmt)
+        second = int(record.created)
+        if second != self._cached_second:
+            self._cached_time = time.strftime(self.default_time_format, self.converter(second))
+            self._cached_second = second
+        return self.default_msec_format % (self._cached_time, record.msecs)
+
+# Creates fixtures in the background while a test sets up its components
+_fixture_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='Fixture')
+
+# Writes the queued log records to stderr, see setup_logging
+_log_listener = None
 
 def setup_logging(debug_mode):
-    """Sets up basic logging configuration."""
+    """
+    Sets up logging once per run. Log calls only put the record on a queue;
+    a background listener formats it and writes it to stderr, so tests never
+    wait on the stream.
+    """
+    global _log_listener
     log_level = logging.DEBUG if debug_mode else logging.INFO
-    logging.basicConfig(
-        level=log_level,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    )
+    if _log_listener is None:
+        log_queue = queue.Queue()
+        logging.config.dictConfig({
+            'version': 1,
+            'disable_existing_loggers': False,
+            'handlers': {
+                'queue': {'()': logging.handlers.QueueHandler, 'queue': log_queue},
+            },
+            'root': {'level': log_level, 'handlers': ['queue']},
+        })
+        stream_handler = logging.StreamHandler()
+        stream_handler.setFormatter(SecondCachedFormatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+        _log_listener = logging.handlers.QueueListener(log_queue, stream_handler)
+        _log_listener.start()
+        # Flushes the records still queued when the run ends
+        atexit.register(_log_listener.stop)
     # Set logger for this script
     logger = logging.getLogger("TestRunner")
-    if debug_mode:
-        logger.setLevel(logging.DEBUG)
-    else:
-        logger.setLevel(logging.INFO)
+    logger.setLevel(log_level)
     return logger
 
-def print_database_contents(db, logger):
-    """Prints all records from the tasks table for debugging."""
+# Formats one row of print_database_contents' task table. The template is
+# parsed once here instead of an f-string being built for every row.
+format_task_row = "{} | {} | {} | {} | {}% | {} | {}".format
+
+def print_database_contents(db, logger, batch_size=1000):
+    """
+    Prints all records from the tasks table for debugging. Rows are read and
+    logged batch_size at a time, each batch as one message. Nothing is
+    queried if the logger would drop INFO messages anyway.
+    """
+    if not logger.isEnabledFor(logging.INFO):
+        return
     logger.info("--- Printing all tasks from the database ---")
-    tasks = db.get_all_tasks()
-    if not tasks:
+    separator = "-" * 100
+    lines = ["ID | Input Path | Processor | Status | Progress | Output Files | Created At", separator]
+    row_count = 0
+    for task in db.iter_all_tasks(batch_size):
+        lines.append(format_task_row(*task))
+        row_count += 1
+        if row_count % batch_size == 0:
+            logger.info("%s", "\n".join(lines))
+            lines = []
+    if not row_count:
         logger.info("No tasks found in the database.")
         return
 
-    logger.info("ID | Input Path | Processor | Status | Progress | Output Files | Created At")
-    logger.info("-" * 100)
-    for task in tasks:
-        task_id, file_path, processor, status, progress, output_files, created_at = task
-        logger.info(f"{task_id} | {file_path} | {processor} | {status} | {progress}% | {output_files} | {created_at}")
-    logger.info("-" * 100)
+    lines.append(separator)
+    logger.info("%s", "\n".join(lines))
 
 def test_file_monitor(config, logger):
     """Tests the FileMonitor component independently."""
+    from file_monitor import FileMonitor
+    from main import start_observer
     logger.info("--- Starting FileMonitor Test ---")
     
     # Initialize Database
     try:
-        db = Database(config=config, debug=True)
-        db.initialize_database()
-    except Exception as e:
+        db = get_test_db(config)
+    except (RuntimeError, OSError) as e:
         logger.error(f"Error initializing database: {e}")
         return
 
@@ -60,37 +298,171 @@ def test_file_monitor(config, logger):
     print_database_contents(db, logger)
 
     # Initialize FileMonitor
+    observer = None
+    file_monitor = None
     try:
         file_monitor = FileMonitor(config=config, db=db, debug=True)
         staleness_check_count = config.get('staleness_check_count', 3)
         monitoring_interval = config.get('monitoring_interval', 5)
 
-        logger.info(f"Simulating {staleness_check_count + 1} monitoring cycles with an interval of {monitoring_interval}s.")
+        logger.info(f"Simulating {staleness_check_count + 1} monitoring cycles instead of waiting {monitoring_interval}s between them.")
 
         # Simulate a mock file being placed in the input folder
         mock_file_path = os.path.join(file_monitor.input_parent_folder, "video_HEVC_height", "360", "sample_test_video.mp4")
         os.makedirs(os.path.dirname(mock_file_path), exist_ok=True)
-        with open(mock_file_path, 'wb') as f:
-            f.write(b'this is a test file to simulate transfer')
-        
+        # Staleness counts unchanged checks, not seconds, so a cycle only has
+        # to wait for a write to finish. The watchdog observer reports it if
+        # available, otherwise each wait simply times out.
+        wakeup = threading.Event()
+        observer = start_observer(file_monitor.input_parent_folder, queue.Queue(), wakeup)
+        # A mock file left by an earlier run is not written again, whatever
+        # its contents if fixtures are kept
+        try:
+            existing_size = os.stat(mock_file_path).st_size
+        except OSError:
+            existing_size = None
+        if existing_size is None or (existing_size != len(MOCK_TRANSFER_DATA) and not keep_fixtures):
+            write_mock_file(mock_file_path, MOCK_TRANSFER_DATA)
+
         # Loop to simulate monitoring cycles
         for i in range(staleness_check_count + 1):
-            logger.debug(f"Monitoring cycle {i+1}/{staleness_check_count+1}")
+            wakeup.wait(timeout=MONITOR_TEST_WAIT)
+            wakeup.clear()
+            if stop_event.is_set():
+                logger.info("FileMonitor test interrupted.")
+                break
+            logger.debug("Monitoring cycle %d/%d", i + 1, staleness_check_count + 1)
             file_monitor.check_for_new_files()
-            time.sleep(monitoring_interval)
             
         logger.info("FileMonitor test completed.")
     except Exception as e:
         logger.error(f"Error running FileMonitor test: {e}")
+    finally:
+        if observer is not None:
+            observer.stop()
+            observer.join()
+        if file_monitor is not None:
+            file_monitor.close()
 
     logger.info("--- Database Contents AFTER Test ---")
     print_database_contents(db, logger)
         
-    db.close()
     logger.info("--- FileMonitor Test Finished ---")
 
+def test_file_monitor_catch_up(config, logger):
+    """
+    Tests that the startup catch-up ends while a media file no processor
+    handles sits in the input folder. Runs against a temporary input folder
+    and database.
+    """
+    from database import Database
+    from file_monitor import FileMonitor
+    logger.info("--- Starting FileMonitor Catch-up Test ---")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        input_folder = os.path.join(temp_dir, 'inbox')
+        test_config = {
+            **config,
+            'input_parent_folder': input_folder,
+            'database_path': os.path.join(temp_dir, 'progress.db'),
+        }
+        matched_path = os.path.join(input_folder, "video_HEVC_height", "360", "sample_test_video.mp4")
+        unmatched_path = os.path.join(input_folder, "other", "unmatched_video.mp4")
+        for path in (matched_path, unmatched_path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_mock_file(path, MOCK_TRANSFER_DATA)
+
+        db = Database(config=test_config, debug=True)
+        file_monitor = None
+        try:
+            if not db.initialize_database():
+                logger.error("Could not initialize the catch-up test's database.")
+                return
+            file_monitor = FileMonitor(config=test_config, db=db, debug=True)
+            staleness_check_count = test_config.get('staleness_check_count', 3)
+            # One scan more than the staleness checks need, so the unmatched
+            # file is seen again after it was dropped
+            for scan in range(1, staleness_check_count + 2):
+                file_monitor.check_for_new_files()
+                if scan >= staleness_check_count and file_monitor.has_unstable_files():
+                    logger.error(f"FAILURE: Catch-up still waiting after scan {scan}: {list(file_monitor.file_status)}")
+                    break
+            else:
+                if matched_path in db.get_all_file_paths():
+                    logger.info("SUCCESS: Catch-up finished with an unmatched file in the input folder.")
+                else:
+                    logger.error(f"FAILURE: No task was added for {matched_path}.")
+        except Exception as e:
+            logger.error(f"Error running FileMonitor catch-up test: {e}")
+        finally:
+            if file_monitor is not None:
+                file_monitor.close()
+            db.close()
+
+    logger.info("--- FileMonitor Catch-up Test Finished ---")
+
+def test_file_monitor_events(config, logger):
+    """
+    Tests that files reported by the file system watcher only become tasks
+    after the usual staleness checks, and that a file still being written is
+    held back. Runs against a temporary input folder and database.
+    """
+    from database import Database
+    from file_monitor import FileMonitor
+    logger.info("--- Starting FileMonitor Events Test ---")
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        input_folder = os.path.join(temp_dir, 'inbox')
+        test_config = {
+            **config,
+            'input_parent_folder': input_folder,
+            'database_path': os.path.join(temp_dir, 'progress.db'),
+        }
+        stable_path = os.path.join(input_folder, "video_HEVC_height", "360", "moved_in_video.mp4")
+        growing_path = os.path.join(input_folder, "video_HEVC_height", "360", "growing_video.mp4")
+        for path in (stable_path, growing_path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            write_mock_file(path, MOCK_TRANSFER_DATA)
+
+        db = Database(config=test_config, debug=True)
+        file_monitor = None
+        try:
+            if not db.initialize_database():
+                logger.error("Could not initialize the events test's database.")
+                return
+            file_monitor = FileMonitor(config=test_config, db=db, debug=True)
+            staleness_check_count = test_config.get('staleness_check_count', 3)
+            for path in (stable_path, growing_path):
+                file_monitor.watch_file(path)
+            for check in range(1, staleness_check_count + 1):
+                if check == staleness_check_count:
+                    if db.get_all_file_paths():
+                        logger.error("FAILURE: A reported file was queued before it was checked as stable.")
+                        return
+                    # The growing file is written to before the last check
+                    with open(growing_path, 'ab') as f:
+                        f.write(MOCK_TRANSFER_DATA)
+                file_monitor.check_watched_files()
+
+            recorded_paths = db.get_all_file_paths()
+            if stable_path not in recorded_paths:
+                logger.error(f"FAILURE: No task was added for {stable_path}.")
+            elif growing_path in recorded_paths:
+                logger.error(f"FAILURE: A task was added for {growing_path} while it was still being written.")
+            else:
+                logger.info("SUCCESS: Reported files were queued only once they were stable.")
+        except Exception as e:
+            logger.error(f"Error running FileMonitor events test: {e}")
+        finally:
+            if file_monitor is not None:
+                file_monitor.close()
+            db.close()
+
+    logger.info("--- FileMonitor Events Test Finished ---")
+
 def test_processor_loading(config, logger):
     """Tests the processor loading functionality."""
+    from processor_loader import load_processors
     logger.info("--- Starting Processor Loading Test ---")
     try:
         # We don't need a DB connection here, just the config
@@ -98,10 +470,10 @@ def test_processor_loading(config, logger):
         
         if 'HEVC Scaler' in processors:
             logger.info("Processor 'HEVC Scaler' loaded successfully.")
-            logger.info(f"Loaded processors: {list(processors.keys())}")
+            logger.info("Loaded processors: %s", list(processors))
         else:
             logger.error("Processor 'HEVC Scaler' was not found after loading.")
-            logger.debug(f"Processors dictionary: {processors}")
+            logger.debug("Processors dictionary: %s", processors)
 
     except Exception as e:
         logger.error(f"Error during processor loading test: {e}")
@@ -112,166 +484,202 @@ def test_hevc_scaler(config, logger):
     """Tests the HEVC Scaler processor with hardcoded inputs."""
     logger.info("--- Starting HEVC Scaler Test ---")
 
+    # Create a mock video file for testing while the database and the
+    # processor are set up
+    mock_video = _fixture_executor.submit(ensure_mock_video, MOCK_VIDEO_PATH, logger)
+
     # Initialize a temporary database
     try:
-        db = Database(config=config, debug=True)
-        db.initialize_database()
-    except Exception as e:
+        db = get_test_db(config)
+    except (RuntimeError, OSError) as e:
         logger.error(f"Error initializing database for HEVC Scaler test: {e}")
         return
 
     # Initialize HEVC Scaler processor
     try:
-        # Get the processor class
-        processors = load_processors(config, db, True)
-        # Instantiate the class with required arguments
-        hevc_scaler = processors.get("HEVC Scaler")
-        
-        # Hardcoded inputs to simulate a task from the MediaController
-        input_file = os.path.join(os.path.dirname(__file__), 'tests', 'sample_video.mp4')
-        task_id = 1
-        params = ["360"]
+        # Instantiate the processor with required arguments
+        hevc_scaler = load_processor(config, db, "HEVC Scaler")
 
-        # Create a mock video file for testing
-        mock_video_path = os.path.join(os.path.dirname(__file__), 'tests', 'sample_video.mp4')
-        os.makedirs(os.path.dirname(mock_video_path), exist_ok=True)
-        # Create a tiny mock video using ffmpeg
-        os.system(f"ffmpeg -f lavfi -i testsrc=size=1280x720:rate=1 -t 5 -c:v libx264 -pix_fmt yuv420p {mock_video_path}")
+        if not mock_video.result():
+            logger.error(f"Could not create the mock video at {MOCK_VIDEO_PATH}.")
+            return
 
-        logger.info(f"Testing HEVC Scaler with file: {input_file}")
+        # Hardcoded inputs to simulate a task from the MediaController
+        input_file = MOCK_VIDEO_PATH
+        # Several heights, so the fused single-decode path is exercised
+        params = ["360+480+720"]
+        with processor_test_task(db, "HEVC Scaler", params) as task_id:
+            if task_id is None:
+                logger.error("Could not add the HEVC Scaler test's task to the database.")
+                return
+
+            logger.info(f"Testing HEVC Scaler with file: {input_file}")
         
-        # Call the process method directly
-        output_files = hevc_scaler.process(input_file, task_id, params)
-
-        # Check if output files were returned
-        if output_files:
-            logger.info("HEVC Scaler test completed successfully.")
-            logger.info(f"Generated output files: {output_files}")
-        else:
-            logger.error("HEVC Scaler test failed: No output files were returned.")
+            # Call the process method directly
+            output_files = hevc_scaler.process(input_file, task_id, params)
+
+            # Check if output files were returned
+            if output_files:
+                logger.info("HEVC Scaler test completed successfully.")
+                logger.info(f"Generated output files: {output_files}")
+            else:
+                logger.error("HEVC Scaler test failed: No output files were returned.")
         
     except Exception as e:
         logger.error(f"Error running HEVC Scaler test: {e}")
     
-    db.close()
     logger.info("--- HEVC Scaler Test Finished ---")
 
+def test_hevc_scaler_heights(config, logger):
+    """
+    Tests how the HEVC Scaler reads target heights from the folder params.
+    Nothing is encoded, so neither FFmpeg nor the database is needed.
+    """
+    logger.info("--- Starting HEVC Scaler Heights Test ---")
+    try:
+        hevc_scaler = load_processor(config, None, "HEVC Scaler")
+        # (params, expected heights, or None if they must be rejected)
+        cases = [
+            (["720"], ["720"]),
+            # Folders below the height folder, e.g. video_HEVC_height/720/2023/
+            (["720", "2023"], ["720"]),
+            (["1080+720+480"], ["1080", "720", "480"]),
+            (["720+"], None),
+            (["99999"], None),
+            (["abc"], None),
+        ]
+        failures = 0
+        for params, expected in cases:
+            try:
+                heights = hevc_scaler._get_heights(params)
+            except ValueError:
+                heights = None
+            if heights != expected:
+                failures += 1
+                logger.error(f"FAILURE: Heights for {params} were {heights}, expected {expected}.")
+        if not failures:
+            logger.info("SUCCESS: All target heights were read as expected.")
+    except Exception as e:
+        logger.error(f"Error running HEVC Scaler heights test: {e}")
+
+    logger.info("--- HEVC Scaler Heights Test Finished ---")
+
 def test_volume_scaler(config, logger):
     """Tests the Volume Scaler processor with hardcoded inputs."""
     logger.info("--- Starting Volume Scaler Test ---")
 
+    # We assume the mock video file from the HEVC Scaler test is available.
+    # Checked first, so nothing is set up when the test cannot run.
+    input_file = MOCK_VIDEO_PATH
+    if not os.path.exists(input_file):
+        logger.error(f"Mock video file not found at {input_file}. Please run 'python3 test_runner.py hevc_scaler' first.")
+        return
+
     # Initialize a temporary database
     try:
-        db = Database(config=config, debug=True)
-        db.initialize_database()
-    except Exception as e:
+        db = get_test_db(config)
+    except (RuntimeError, OSError) as e:
         logger.error(f"Error initializing database for Volume Scaler test: {e}")
         return
 
     # Initialize Volume Scaler processor
     try:
-        # Get the processor class
-        processors = load_processors(config, db, True)
         # Get the Volume Scaler instance
-        volume_scaler = processors.get("Volume Scaler")
+        volume_scaler = load_processor(config, db, "Volume Scaler")
         
         # Hardcoded inputs to simulate a task from the MediaController
-        input_file = os.path.join(os.path.dirname(__file__), 'tests', 'sample_video.mp4')
-        task_id = 1
         params = ["2.0"] # 2x volume increase
+        with processor_test_task(db, "Volume Scaler", params) as task_id:
+            if task_id is None:
+                logger.error("Could not add the Volume Scaler test's task to the database.")
+                return
 
-        # We assume the mock video file from the HEVC Scaler test is available
-        if not os.path.exists(input_file):
-            logger.error(f"Mock video file not found at {input_file}. Please run 'python3 test_runner.py hevc_scaler' first.")
-            return
-
-        logger.info(f"Testing Volume Scaler with file: {input_file}")
+            logger.info(f"Testing Volume Scaler with file: {input_file}")
         
-        # Call the process method directly
-        output_files = volume_scaler.process(input_file, task_id, params)
-
-        # Check if output files were returned
-        if output_files:
-            logger.info("Volume Scaler test completed successfully.")
-            logger.info(f"Generated output files: {output_files}")
-        else:
-            logger.error("Volume Scaler test failed: No output files were returned.")
+            # Call the process method directly
+            output_files = volume_scaler.process(input_file, task_id, params)
+
+            # Check if output files were returned
+            if output_files:
+                logger.info("Volume Scaler test completed successfully.")
+                logger.info(f"Generated output files: {output_files}")
+            else:
+                logger.error("Volume Scaler test failed: No output files were returned.")
         
     except Exception as e:
         logger.error(f"Error running Volume Scaler test: {e}")
     
-    db.close()
     logger.info("--- Volume Scaler Test Finished ---")
 
 def test_hevc_bitrate_scaler(config, logger):
     """Tests the HEVC Bitrate Scaler processor with hardcoded inputs."""
     logger.info("--- Starting HEVC Bitrate Scaler Test ---")
 
+    # We assume the mock video file from the HEVC Scaler test is available.
+    # Checked first, so nothing is set up when the test cannot run.
+    input_file = MOCK_VIDEO_PATH
+    if not os.path.exists(input_file):
+        logger.error(f"Mock video file not found at {input_file}. Please run 'python3 test_runner.py hevc_scaler' first.")
+        return
+
     # Initialize a temporary database
     try:
-        db = Database(config=config, debug=True)
-        db.initialize_database()
-    except Exception as e:
+        db = get_test_db(config)
+    except (RuntimeError, OSError) as e:
         logger.error(f"Error initializing database for HEVC Bitrate Scaler test: {e}")
         return
 
     # Initialize HEVC Bitrate Scaler processor
     try:
         # Get the processor instance
-        processors = load_processors(config, db, True)
-        hevc_bitrate_scaler = processors.get("HEVC Bitrate Scaler")
+        hevc_bitrate_scaler = load_processor(config, db, "HEVC Bitrate Scaler")
         
         # Hardcoded inputs to simulate a task from the MediaController
-        input_file = os.path.join(os.path.dirname(__file__), 'tests', 'sample_video.mp4')
-        task_id = 1
         params = ["200"] # 200k bitrate
+        with processor_test_task(db, "HEVC Bitrate Scaler", params) as task_id:
+            if task_id is None:
+                logger.error("Could not add the HEVC Bitrate Scaler test's task to the database.")
+                return
 
-        # We assume the mock video file from the HEVC Scaler test is available
-        if not os.path.exists(input_file):
-            logger.error(f"Mock video file not found at {input_file}. Please run 'python3 test_runner.py hevc_scaler' first.")
-            return
-
-        logger.info(f"Testing HEVC Bitrate Scaler with file: {input_file}")
+            logger.info(f"Testing HEVC Bitrate Scaler with file: {input_file}")
         
-        # Call the process method directly
-        output_files = hevc_bitrate_scaler.process(input_file, task_id, params)
-
-        # Check if output files were returned
-        if output_files:
-            logger.info("HEVC Bitrate Scaler test completed successfully.")
-            logger.info(f"Generated output files: {output_files}")
-        else:
-            logger.error("HEVC Bitrate Scaler test failed: No output files were returned.")
+            # Call the process method directly
+            output_files = hevc_bitrate_scaler.process(input_file, task_id, params)
+
+            # Check if output files were returned
+            if output_files:
+                logger.info("HEVC Bitrate Scaler test completed successfully.")
+                logger.info(f"Generated output files: {output_files}")
+            else:
+                logger.error("HEVC Bitrate Scaler test failed: No output files were returned.")
         
     except Exception as e:
         logger.error(f"Error running HEVC Bitrate Scaler test: {e}")
     
-    db.close()
     logger.info("--- HEVC Bitrate Scaler Test Finished ---")
 
 
 def test_file_monitor_purge(config, logger):
     """Tests the FileMonitor's purge_completed_inputs method."""
+    from file_monitor import FileMonitor
     logger.info("--- Starting File Monitor Purge Test ---")
 
     # Initialize Database
     try:
-        db = Database(config=config, debug=True)
-        db.initialize_database()
-    except Exception as e:
+        db = get_test_db(config)
+    except (RuntimeError, OSError) as e:
         logger.error(f"Error initializing database: {e}")
         return
 
     # Create a mock completed task in the database
-    mock_file_path = os.path.join(os.path.dirname(__file__), "tests", "mock_file_to_purge.mp4")
-    os.makedirs(os.path.dirname(mock_file_path), exist_ok=True)
-    with open(mock_file_path, 'wb') as f:
-        f.write(b'This is a mock file to be purged.')
+    mock_file_path = MOCK_PURGE_PATH
+    os.makedirs(TESTS_DIR, exist_ok=True)
+    write_mock_file(mock_file_path, b'This is a mock file to be purged.')
 
-    # Manually add a completed task to the database
-    task_id = db.add_task(mock_file_path, "HEVC Scaler", json.dumps(["360"]))
-    db.update_task_status(task_id, 'completed')
-    db.update_task_output_files(task_id, json.dumps(["/some/output/path.mp4"]))
+    # Manually add a completed task to the database, committed once
+    with db.transaction():
+        task_id = db.add_task(mock_file_path, "HEVC Scaler", MOCK_PURGE_PARAMS)
+        db.update_task_status(task_id, 'completed', output_files=["/some/output/path.mp4"])
 
     logger.info(f"Created mock file at {mock_file_path} and added a completed task to the database.")
     
@@ -279,12 +687,16 @@ def test_file_monitor_purge(config, logger):
     print_database_contents(db, logger)
 
     # Initialize FileMonitor and run the purge
+    file_monitor = None
     try:
         file_monitor = FileMonitor(config=config, db=db, debug=True)
         file_monitor.purge_completed_inputs()
         logger.info("Purge process completed.")
     except Exception as e:
         logger.error(f"Error during purge process: {e}")
+    finally:
+        if file_monitor is not None:
+            file_monitor.close()
         
     logger.info("--- Database Contents AFTER Purge ---")
     print_database_contents(db, logger)
@@ -295,19 +707,18 @@ def test_file_monitor_purge(config, logger):
     else:
         logger.error(f"FAILURE: The input file at {mock_file_path} was NOT purged.")
 
-    db.close()
     logger.info("--- File Monitor Purge Test Finished ---")
 
 
 def test_media_controller(config, logger):
     """Tests the MediaController component independently."""
+    from media_controller import MediaController
     logger.info("--- Starting MediaController Test ---")
     
     # Initialize Database
     try:
-        db = Database(config=config, debug=True)
-        db.initialize_database()
-    except Exception as e:
+        db = get_test_db(config)
+    except (RuntimeError, OSError) as e:
         logger.error(f"Error initializing database: {e}")
         return
         
@@ -318,6 +729,8 @@ def test_media_controller(config, logger):
     try:
         media_controller = MediaController(config=config, db=db, debug=True)
         media_controller.process_pending_tasks()
+        # Wait for the worker pool to finish the queued tasks
+        media_controller.shutdown(cancel_pending=False)
         logger.info("MediaController test completed. Check logs for updated tasks.")
     except Exception as e:
         logger.error(f"Error running MediaController test: {e}")
@@ -325,22 +738,79 @@ def test_media_controller(config, logger):
     logger.info("--- Database Contents AFTER Test ---")
     print_database_contents(db, logger)
         
-    db.close()
     logger.info("--- MediaController Test Finished ---")
 
+@contextmanager
+def stop_on_interrupt():
+    """
+    While the block runs, the first Ctrl-C only sets stop_event, and a
+    second one aborts right away. The handler does nothing else: logging
+    from it could deadlock on the log queue's lock. Only for tests that
+    check stop_event, on the main thread.
+    """
+    def handle_interrupt(signum, frame):
+        if stop_event.is_set():
+            raise KeyboardInterrupt
+        stop_event.set()
+
+    previous = signal.signal(signal.SIGINT, handle_interrupt)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGINT, previous)
+
+# The test function of each component that can be named on the command line
+TEST_COMPONENTS = {
+    'file_monitor': test_file_monitor,
+    'file_monitor_catch_up': test_file_monitor_catch_up,
+    'file_monitor_events': test_file_monitor_events,
+    'media_controller': test_media_controller,
+    'processor_loading': test_processor_loading,
+    'hevc_scaler': test_hevc_scaler,
+    'hevc_scaler_heights': test_hevc_scaler_heights,
+    'volume_scaler': test_volume_scaler,
+    'file_monitor_purge': test_file_monitor_purge,
+    'hevc_bitrate_scaler': test_hevc_bitrate_scaler,
+}
+
+# Tests that check stop_event, so Ctrl-C lets them finish their current
+# step. Ctrl-C interrupts the others right away.
+STOPPABLE_TESTS = frozenset({'file_monitor'})
+
+# The processor tests, all run by the 'processors' component. They only
+# share the mock video, so they can run at the same time.
+PROCESSOR_TESTS = ('hevc_scaler', 'volume_scaler', 'hevc_bitrate_scaler')
+
+def load_config(config_path):
+    """
+    Parses the configuration file once for the whole run. The result is
+    read-only, since all tests running at the same time share it.
+    """
+    with open(config_path, 'rb') as f:
+        data = f.read()
+    config = orjson.loads(data) if orjson is not None else json.loads(data)
+    return MappingProxyType(config)
+
 def main():
     """Main function to run the test suite."""
     parser = argparse.ArgumentParser(description="Run tests for media processor components.")
-    parser.add_argument('test_component', type=str, choices=['file_monitor', 'media_controller', 'processor_loading', 'hevc_scaler', 'volume_scaler', 'file_monitor_purge', 'hevc_bitrate_scaler'],
-                        help='The component to test.')
+    parser.add_argument('test_component', type=str, nargs='+', choices=list(TEST_COMPONENTS) + ['processors'],
+                        help='The components to test. Processor tests run at the same time, the other '
+                             "components one after another. 'processors' tests all processors.")
     parser.add_argument('--config_path', type=str, default='config/config.json',
                         help='Path to the configuration file.')
+    parser.add_argument('--in_memory_db', action='store_true',
+                        help='Use a throwaway in-memory database instead of the configured one. '
+                             'Components are then tested one after another.')
+    parser.add_argument('--keep_fixtures', action='store_true',
+                        help='Use existing fixture files as they are instead of rewriting ones that differ.')
     args = parser.parse_args()
+    global keep_fixtures
+    keep_fixtures = args.keep_fixtures
 
     # Load configuration
     try:
-        with open(args.config_path, 'r') as f:
-            config = json.load(f)
+        config = load_config(args.config_path)
     except FileNotFoundError:
         print(f"Error: Configuration file not found at {args.config_path}")
         return
@@ -350,20 +820,45 @@ def main():
 
     logger = setup_logging(debug_mode=True)
 
-    if args.test_component == 'file_monitor':
-        test_file_monitor(config, logger)
-    elif args.test_component == 'media_controller':
-        test_media_controller(config, logger)
-    elif args.test_component == 'processor_loading':
-        test_processor_loading(config, logger)
-    elif args.test_component == 'hevc_scaler':
-        test_hevc_scaler(config, logger)
-    elif args.test_component == 'volume_scaler':
-        test_volume_scaler(config, logger)
-    elif args.test_component == 'file_monitor_purge':
-        test_file_monitor_purge(config, logger)
-    elif args.test_component == 'hevc_bitrate_scaler':
-        test_hevc_bitrate_scaler(config, logger)
+    def run_test(component):
+        # Each component logs under its own name, so interleaved lines stay attributable
+        TEST_COMPONENTS[component](config, logger.getChild(component))
+
+    components = []
+    for component in args.test_component:
+        components += PROCESSOR_TESTS if component == 'processors' else [component]
+    # The other tests share task rows, so they run one after another in the
+    # order of TEST_COMPONENTS: the FileMonitor test queues the tasks the
+    # MediaController test processes, and the purge test then removes the
+    # inputs of completed tasks. Only the processor tests run at the same time.
+    sequential = [c for c in TEST_COMPONENTS if c in components and c not in PROCESSOR_TESTS]
+    concurrent = [c for c in PROCESSOR_TESTS if c in components]
+    # The other processor tests use the HEVC Scaler test's mock video, so
+    # when they run alongside it the video is created before any starts
+    if 'hevc_scaler' in concurrent and len(concurrent) > 1:
+        ensure_mock_video(MOCK_VIDEO_PATH, logger)
+    max_workers = min(len(concurrent), os.cpu_count() or 1)
+    if args.in_memory_db:
+        from database import IN_MEMORY_PATH
+        config = MappingProxyType({**config, 'database_path': IN_MEMORY_PATH})
+        # Writers on a shared-cache in-memory database fail instead of waiting for each other
+        max_workers = 1
+    try:
+        for component in sequential:
+            if component in STOPPABLE_TESTS:
+                with stop_on_interrupt():
+                    run_test(component)
+                if stop_event.is_set():
+                    logger.info("Interrupted. Skipping the remaining tests.")
+                    return
+            else:
+                run_test(component)
+        if concurrent:
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                list(executor.map(run_test, concurrent))
+    finally:
+        if _test_db is not None:
+            _test_db.close()
     
 if __name__ == "__main__":
     main()